@@ -2,19 +2,23 @@
 # -*- mode:python; indent-tabs-mode:t; python-indent:4 -*-
 
 import sys
+import abc
 import subprocess
 import os
 import time
 import shutil
 import tempfile
-import io
 import re
 import curses
 import fcntl
 import mediainfo
 import argparse
+import bisect
+import json
+import socket
+import stat
+import multiprocessing
 import threading
-import Queue as queue
 
 class VideoEncoderError(Exception): pass
 class InsufficientOptionsError(VideoEncoderError): pass
@@ -25,8 +29,21 @@ class CancelByUserError(VideoEncoderError): pass
 class MediaFileNotSupportedError(VideoEncoderError): pass
 
 class EncodeExecutor:
-	def __init__(self, infile, outfile, mi, ffmpegCommonOpts):
-		self.queue = queue.Queue()
+	# Compiled pattern of the progress lines in the encoder's stderr.
+	progressPattern = None
+	lineSeparator = re.compile(br'[\r\n]')
+	readSize = 65536
+	maxLineLength = 4096
+
+	# ffmpeg output options for the raw input of the encoder
+	decoderOpts = None
+
+	def __init__(self, infile, outfile, mi, ffmpegCommonOpts, threads=None):
+		self.threads = threads
+		self.inputFd = None  # read end of a pipe from a shared decoder
+		self.decoder = None
+		self.updateEvent = None
+		self.latestMatch = None
 		self.infile = infile
 		self.outfile = outfile
 		self.mi = mi
@@ -37,30 +54,86 @@ class EncodeExecutor:
 
 	def start(self):
 		self.proc = self.startProcess()
-		t = threading.Thread(target = self.asyncQueueThread, args=(self.proc.stderr,))
+		t = threading.Thread(target = self.readerThread, args=(self.proc.stderr.fileno(),))
 		t.daemon = True
 		t.start()
 		pass
 
-	def asyncQueueThread(self, fp):
-		q = self.queue
-		buf = io.BytesIO()
+	def startEncoder(self, cmd, ffmpegOpts):
+		# Starts the encoder reading from inputFd if given, or from an
+		# ffmpeg process of its own.
+		if self.inputFd == None:
+			self.decoder = subprocess.Popen(
+				["ffmpeg"] + self.ffmpegCommonOpts + ffmpegOpts + self.decoderOpts + ['-'],
+				stdout = subprocess.PIPE,
+				stderr = subprocess.PIPE,
+				shell = False)
+			stdin = self.decoder.stdout
+		else:
+			stdin = self.inputFd
+		proc = subprocess.Popen(
+			cmd,
+			stdin = stdin,
+			stdout = subprocess.PIPE,
+			stderr = subprocess.PIPE,#
+			shell = False)
+		# Only the encoder keeps the read end, so that the decoder gets
+		# SIGPIPE if the encoder dies.
+		if self.inputFd == None:
+			self.decoder.stdout.close()
+		else:
+			os.close(self.inputFd)
+			self.inputFd = None
+		return proc
+
+	def setUpdateEvent(self, event):
+		# event is set on each progress sample and when the encoder exits.
+		self.updateEvent = event
+
+	def notifyUpdate(self):
+		if self.updateEvent != None:
+			self.updateEvent.set()
+
+	def readerThread(self, fd):
+		# Reads whatever is available in the pipe at a time and keeps only
+		# the match of the latest progress line; older samples are useless.
+		pending = b''
 		while True:
-			data = fp.read(1)
+			data = os.read(fd, self.readSize)
 			if len(data) == 0: break
-			if data == "\n" or data == "\r":
-				q.put(buf.getvalue())
-				buf.truncate(0)
-			else:
-				buf.write(data)
+			lines = self.lineSeparator.split(pending + data)
+			pending = lines.pop()[-self.maxLineLength:]
+			for line in reversed(lines):
+				match = self.progressPattern.search(line)
+				if match != None:
+					self.latestMatch = match
+					self.notifyUpdate()
+					break
+		# End of stderr; the encoder is exiting. Reap it before waking up
+		# the loop, or getReturnCode() could still return None.
+		self.proc.wait()
+		self.notifyUpdate()
 	
 	def getReturnCode(self):
 		if self.proc == None: return None
 		return self.proc.poll()
 
+	def finish(self):
+		# Called after the encoder has exited successfully.
+		pass
+
+	def kill(self):
+		if self.getReturnCode() == None and self.proc != None:
+			self.proc.kill()
+		if self.decoder != None and self.decoder.poll() == None:
+			self.decoder.kill()
+
 class VideoEncodeExecutor(EncodeExecutor):
-	def __init__(self, infile, outfile, mi, ffmpegCommonOpts):
-		EncodeExecutor.__init__(self, infile, outfile, mi, ffmpegCommonOpts)
+	progressPattern = re.compile(br'(\d+) *\/ *(\d+) *frames')
+	decoderOpts = ['-f', 'rawvideo', '-vcodec', 'rawvideo', '-pix_fmt', 'yuv420p']
+
+	def __init__(self, infile, outfile, mi, ffmpegCommonOpts, threads=None):
+		EncodeExecutor.__init__(self, infile, outfile, mi, ffmpegCommonOpts, threads)
 
 		frameCount = mi['Video'].get('FrameCount', '')
 		if frameCount == '':
@@ -72,7 +145,6 @@ class VideoEncodeExecutor(EncodeExecutor):
 		mi = self.mi
 		width  = mi['Video']['Width']
 		height = mi['Video']['Height']
-		ffmpegVideoOpts = ['-an', '-f', 'rawvideo', '-vcodec', 'rawvideo', '-pix_fmt', 'yuv420p', '-']
 		x264Opts = [ ]
 		x264Opts += ['--output', self.outfile]
 		x264Opts += ['-']
@@ -99,35 +171,23 @@ class VideoEncodeExecutor(EncodeExecutor):
 		# ultrafast, superfast, veryfast, faster, fast, medium, slow, slower, veryslow, placebo
 		# def:medium
 		x264Opts += ['--preset', 'veryfast']
-		
-		ffmpegOpts = self.ffmpegCommonOpts + ffmpegVideoOpts
-		poVideo1 = subprocess.Popen(
-			["ffmpeg"] + ffmpegOpts,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,
-			shell = False)
-		poVideo  = subprocess.Popen(
-			["x264"] + x264Opts,
-			stdin = poVideo1.stdout,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,#
-			shell = False)
 
-		return poVideo
+		if self.threads != None:
+			x264Opts += ['--threads', str(self.threads)]
+		
+		return self.startEncoder(["x264"] + x264Opts, ['-an'])
 
 	def getProgress(self):
-		while True:
-			try:
-				line = self.queue.get_nowait()
-				match = re.search('(\d+) *\/ *(\d+) *frames', line);
-				if match != None:
-					self.progress = int( match.group(1) )
-			except queue.Empty:
-				break
+		match = self.latestMatch
+		if match != None:
+			self.progress = int( match.group(1) )
 		return (self.progress, self.totalFrameCount)
 
 
 class AudioEncodeExecutor(EncodeExecutor):
+	progressPattern = re.compile(br'(\d+) *\| +(\d+\.\d+) *\| *(\d+\.\d+)x')
+	decoderOpts = ['-f', 'wav']
+
 	def __init__(self, infile, outfile, mi, ffmpegCommonOpts):
 		EncodeExecutor.__init__(self, infile, outfile, mi, ffmpegCommonOpts)
 		self.frameCount = 0
@@ -135,7 +195,6 @@ class AudioEncodeExecutor(EncodeExecutor):
 	def startProcess(self):
 		mi = self.mi["Audio"]
 		
-		ffmpegAudioOpts = ['-vn', '-f', 'wav', '-']
 		faacOpts = ['--no-midside']
 		
 		# Sampling rate
@@ -152,35 +211,317 @@ class AudioEncodeExecutor(EncodeExecutor):
 
 		faacOpts += ['-o', self.outfile, '-']
 		
-		poAudio1 = subprocess.Popen(
-			['ffmpeg'] + self.ffmpegCommonOpts + ffmpegAudioOpts,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,
-			shell = False)
-		poAudio  = subprocess.Popen(
-			['faac'] + faacOpts,
-			stdin = poAudio1.stdout,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,#
-			shell = False)
-		return poAudio
+		return self.startEncoder(['faac'] + faacOpts, ['-vn'])
 
 	def getProgress(self):
-		while True:
-			try:
-				line = self.queue.get_nowait()
-				match = re.search('(\d+) *\| +(\d+\.\d+) *\| *(\d+\.\d+)x', line);
-				if match != None:
-					self.frameCount = int( match.group(1) )
-			except queue.Empty:
-				break
+		match = self.latestMatch
+		if match != None:
+			self.frameCount = int( match.group(1) )
 		return (self.frameCount, None)
-	
+
+
+class SegmentedVideoEncodeExecutor:
+	"""
+	Encodes the video in time segments, running up to maxJobs
+	VideoEncodeExecutors at a time, and concatenates their H.264
+	elementary streams into outfile on finish(). It has the same interface
+	as EncodeExecutor, and is advanced by the polling of getReturnCode().
+	"""
+	def __init__(self, infile, outfile, mi, segments, maxJobs, threads=None):
+		"""
+		segments: list of (ffmpegCommonOpts, estimated frame count).
+		threads: number of encoder threads shared by the running segments.
+		"""
+		self.infile = infile
+		self.outfile = outfile
+		self.mi = mi
+		self.maxJobs = maxJobs
+		self.progress = 0
+
+		# x264 must not stop at the frame count of the whole input.
+		segmentMi = dict(mi)
+		segmentMi['Video'] = dict(mi['Video'], FrameCount='')
+		segmentThreads = None if threads == None else max(1, threads // maxJobs)
+
+		self.pending = [ ]
+		self.segmentOutfiles = [ ]
+		for i, (opts, frameCount) in enumerate(segments):
+			segmentOutfile = '%s.%d' % (outfile, i)
+			self.segmentOutfiles.append(segmentOutfile)
+			self.pending.append((VideoEncodeExecutor(infile, segmentOutfile, segmentMi, opts, segmentThreads), frameCount))
+		self.pending.reverse()
+		self.running = [ ]
+		self.finishedFrames = 0
+		self.totalFrameCount = sum(frameCount for opts, frameCount in segments)
+		self.returnCode = None
+
+	def start(self):
+		self.startPending()
+
+	def setUpdateEvent(self, event):
+		for executor, frameCount in self.pending + self.running:
+			executor.setUpdateEvent(event)
+
+	def startPending(self):
+		while len(self.running) < self.maxJobs and len(self.pending) > 0:
+			segment = self.pending.pop()
+			segment[0].start()
+			self.running.append(segment)
+
+	def kill(self):
+		for executor, frameCount in self.running:
+			executor.kill()
+		self.running = [ ]
+		self.pending = [ ]
+
+	def finish(self):
+		# Done after the progress loop, as copying the segments may take
+		# a while.
+		with open(self.outfile, 'wb') as fout:
+			for segmentOutfile in self.segmentOutfiles:
+				with open(segmentOutfile, 'rb') as fin:
+					shutil.copyfileobj(fin, fout, 1024 * 1024)
+				os.remove(segmentOutfile)
+
+	def getReturnCode(self):
+		if self.returnCode != None: return self.returnCode
+		for segment in list(self.running):
+			executor, frameCount = segment
+			ret = executor.getReturnCode()
+			if ret == None: continue
+			if ret != 0:
+				self.kill()
+				self.returnCode = ret
+				return ret
+			self.running.remove(segment)
+			self.finishedFrames += max(frameCount, executor.getProgress()[0])
+		self.startPending()
+		if len(self.running) == 0:
+			self.returnCode = 0
+		return self.returnCode
+
+	def getProgress(self):
+		progress = self.finishedFrames
+		for executor, frameCount in self.running:
+			progress += min(executor.getProgress()[0], frameCount)
+		self.progress = progress
+		return (self.progress, self.totalFrameCount)
+
+
+class FfmpegEncodeExecutor(EncodeExecutor):
+	"""
+	Encodes the video with libx264 and the audio with aac in one ffmpeg
+	process, which writes the raw H.264 and ADTS AAC streams. Either outfile
+	may be None.
+	"""
+	progressPattern = re.compile(br'^frame=(\d+)')
+
+	def __init__(self, infile, videoOutfile, audioOutfile, mi, ffmpegCommonOpts, threads=None):
+		EncodeExecutor.__init__(self, infile, videoOutfile, mi, ffmpegCommonOpts, threads)
+		self.audioOutfile = audioOutfile
+
+		frameCount = mi['Video'].get('FrameCount', '') if videoOutfile != None else ''
+		if frameCount == '':
+			self.totalFrameCount = None
+		else:
+			self.totalFrameCount = int(frameCount)
+
+	def startProcess(self):
+		opts = self.ffmpegCommonOpts + ['-nostats', '-progress', 'pipe:2']
+		if self.outfile != None:
+			# Same settings as the x264 command line of VideoEncodeExecutor.
+			opts += ['-map', '0:v:0', '-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+			opts += ['-crf', str(24.0), '-preset', 'veryfast']
+			opts += ['-x264-params', 'b-pyramid=none:keyint=100']
+			if self.threads != None:
+				opts += ['-threads', str(self.threads)]
+			opts += ['-f', 'h264', self.outfile]
+		if self.audioOutfile != None:
+			mi = self.mi['Audio']
+			opts += ['-map', '0:a:0', '-c:a', 'aac', '-b:a', '128k']
+			if 'SamplingRate' in mi and '' != mi['SamplingRate']:
+				opts += ['-ar', mi['SamplingRate']]
+			opts += ['-f', 'adts', self.audioOutfile]
+
+		devnull = open(os.devnull, 'rb')
+		try:
+			return subprocess.Popen(
+				['ffmpeg', '-y'] + opts,
+				stdin = devnull,
+				stdout = subprocess.PIPE,
+				stderr = subprocess.PIPE,
+				shell = False)
+		finally:
+			devnull.close()
+
+	def getProgress(self):
+		match = self.latestMatch
+		if match != None:
+			self.progress = int( match.group(1) )
+		return (self.progress, self.totalFrameCount)
+
+
+class EncoderBackend(metaclass=abc.ABCMeta):
+	"""
+	Creates the executors which encode the input into the raw H.264 and AAC
+	streams muxed by VideoEncoder.
+	"""
+	# Whether the outputs may be named pipes opened by separate readers.
+	supportsPipeline = True
+
+	@abc.abstractmethod
+	def createExecutors(self, encoder, videoOutfile, audioOutfile, videoThreads):
+		"""
+		Returns (video executor, audio executor). Either may be None, if
+		the output is disabled or written by the other executor.
+		"""
+		pass
+
+class ExternalEncoderBackend(EncoderBackend):
+	# ffmpeg decodes, and x264 and faac encode through pipes.
+	def createExecutors(self, encoder, videoOutfile, audioOutfile, videoThreads):
+		infile = encoder.args.infile
+		videoExec = None
+		audioExec = None
+		if videoOutfile != None:
+			if encoder.args.segments > 1:
+				segments = encoder.getSegments(encoder.args.segments)
+				encoder.logVerbose('Encoding video in %d segments.' % len(segments))
+				maxJobs = encoder.args.jobs or multiprocessing.cpu_count()
+				videoExec = SegmentedVideoEncodeExecutor(infile, videoOutfile, encoder.mi, segments, maxJobs, videoThreads)
+			else:
+				videoExec = VideoEncodeExecutor(infile, videoOutfile, encoder.mi, encoder.getFfmpegCommonOpts(), videoThreads)
+		if audioOutfile != None:
+			audioExec = AudioEncodeExecutor(infile, audioOutfile, encoder.mi, encoder.getFfmpegCommonOpts())
+		return (videoExec, audioExec)
+
+class FfmpegEncoderBackend(EncoderBackend):
+	# One ffmpeg process decodes once and encodes both streams, so no raw
+	# frames go through pipes.
+	# ffmpeg opens all its outputs before writing any, which would block on
+	# named pipes read one after another by the muxer.
+	supportsPipeline = False
+
+	def createExecutors(self, encoder, videoOutfile, audioOutfile, videoThreads):
+		if encoder.args.segments > 1:
+			raise VideoEncoderError('--segments is not supported by backend ffmpeg.')
+		if videoOutfile == None and audioOutfile == None:
+			return (None, None)
+		# The output options of ffmpeg apply only to the next output.
+		opts = encoder.getFfmpegCommonOpts(encoder.args.start)
+		executor = FfmpegEncodeExecutor(encoder.args.infile, videoOutfile, audioOutfile, encoder.mi, opts, videoThreads)
+		return (executor, None)
+
+class SharedDecodeEncoderBackend(EncoderBackend):
+	# Like external, but one ffmpeg process decodes the input once and
+	# writes the raw video and audio to two pipes read by x264 and faac.
+	# The decoder blocks on whichever pipe is full, which could stall the
+	# muxer reading named pipes in turn.
+	supportsPipeline = False
+
+	def createExecutors(self, encoder, videoOutfile, audioOutfile, videoThreads):
+		if videoOutfile == None or audioOutfile == None:
+			# Nothing to share.
+			return ExternalEncoderBackend().createExecutors(encoder, videoOutfile, audioOutfile, videoThreads)
+		if encoder.args.segments > 1:
+			raise VideoEncoderError('--segments is not supported by backend shared.')
+
+		infile = encoder.args.infile
+		# The output options of ffmpeg apply only to the next output.
+		opts = encoder.getFfmpegCommonOpts(encoder.args.start)
+		videoExec = VideoEncodeExecutor(infile, videoOutfile, encoder.mi, opts, videoThreads)
+		audioExec = AudioEncodeExecutor(infile, audioOutfile, encoder.mi, opts)
+
+		(videoExec.inputFd, videoWriteFd) = os.pipe()
+		(audioExec.inputFd, audioWriteFd) = os.pipe()
+		cmd = ['ffmpeg'] + opts
+		cmd += ['-map', '0:v:0'] + VideoEncodeExecutor.decoderOpts + ['pipe:%d' % videoWriteFd]
+		cmd += ['-map', '0:a:0'] + AudioEncodeExecutor.decoderOpts + ['pipe:%d' % audioWriteFd]
+		devnull = open(os.devnull, 'r+b')
+		try:
+			decoder = subprocess.Popen(
+				cmd,
+				stdin = devnull,
+				stdout = devnull,
+				stderr = devnull,
+				pass_fds = (videoWriteFd, audioWriteFd),
+				shell = False)
+		finally:
+			devnull.close()
+			os.close(videoWriteFd)
+			os.close(audioWriteFd)
+		videoExec.decoder = decoder
+		audioExec.decoder = decoder
+		return (videoExec, audioExec)
+
+encoderBackends = {
+	'external': ExternalEncoderBackend,
+	'ffmpeg': FfmpegEncoderBackend,
+	'shared': SharedDecodeEncoderBackend,
+}
+
+
+class Telemetry:
+	"""
+	Writes records as JSON lines to a file, or to a socket given as
+	tcp:HOST:PORT or unix:PATH. Each record has 'event' and 'time' keys and
+	the given common fields.
+	"""
+	def __init__(self, dest, fields=None):
+		self.fields = fields or { }
+		self.sock = None
+		self.file = None
+		if dest.startswith('tcp:'):
+			(host, port) = dest[4:].rsplit(':', 1)
+			self.sock = socket.create_connection((host, int(port)))
+		elif dest.startswith('unix:'):
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				sock.connect(dest[5:])
+			except:
+				sock.close()
+				raise
+			self.sock = sock
+		else:
+			self.file = open(dest, 'a')
+
+	def emit(self, event, **record):
+		if self.sock == None and self.file == None: return
+		record.update(self.fields)
+		record['event'] = event
+		record['time'] = time.time()
+		line = json.dumps(record, sort_keys=True) + "\n"
+		try:
+			if self.sock != None:
+				self.sock.sendall(line.encode('utf-8'))
+			else:
+				self.file.write(line)
+				self.file.flush()
+		except (IOError, OSError) as e:
+			# Losing the telemetry must not fail the encode.
+			sys.stderr.write('Telemetry disabled: %s\n' % e)
+			self.close()
+
+	def close(self):
+		if self.sock != None:
+			self.sock.close()
+			self.sock = None
+		if self.file != None:
+			self.file.close()
+			self.file = None
+
 
 class VideoEncoder:
+	# Minimum interval of progress output
+	progressInterval = 0.5
+	# Seconds the encoders may run after the muxer in pipeline mode
+	muxerExitTimeout = 5
+
 	def __init__(self):
 		self.mi = None
 		self.retcode = 1
+		self.telemetry = None
+		self.stages = { }
 		
 		self.stdscr = None
 		self.argsParser = None
@@ -191,14 +532,25 @@ class VideoEncoder:
 	def getArgumentParser(self):
 		if self.argsParser: return self.argsParser
 		parser = argparse.ArgumentParser(conflict_handler='resolve')
-		parser.add_argument('--infile', '-i', dest='infile', required = True)
-		parser.add_argument('--outfile', '-o', required = True)
+		parser.add_argument('--infile', '-i', dest='infile')
+		parser.add_argument('--outfile', '-o', help='Output file, or output directory in batch mode.')
 		parser.add_argument('--start', type=float, default=0)
 		parser.add_argument('--verbose', action='store_const', const=True)
 		parser.add_argument('--force', dest='forceOverwrite', action='store_const', const=True)
 		parser.add_argument('--duration', type=float, default=float('inf'))
 		parser.add_argument('--noaudio', dest='noAudio', action='store_const', const=True)
 		parser.add_argument('--progress', action='store_const', const=True)
+		parser.add_argument('--fastprobe', dest='fastProbe', action='store_const', const=True)
+		parser.add_argument('--segments', type=int, default=1, help='Split the video into this many keyframe-aligned segments encoded in parallel.')
+		parser.add_argument('--jobs', type=int, default=None, help='Maximum number of segments encoded at a time (def: number of CPUs).')
+		parser.add_argument('--backend', default='external', choices=sorted(encoderBackends.keys()), help='external: ffmpeg piped to x264 and faac (def). ffmpeg: libx264 and aac in one ffmpeg process. shared: one ffmpeg decode piped to both x264 and faac.')
+		parser.add_argument('--pipeline', action='store_const', const=True, help='Mux the encoder outputs through named pipes while encoding, without intermediate files.')
+		parser.add_argument('--telemetry', help='Write progress and stage records as JSON lines to a file, or a socket given as tcp:HOST:PORT or unix:PATH.')
+		parser.add_argument('--threads', type=int, default=None, help='Number of CPUs to use. One is left to the audio encoder.')
+		parser.add_argument('--batch', help='Encode the files listed in a manifest (one "infile[<TAB>outfile]" per line) or found in a directory.')
+		parser.add_argument('--batch-jobs', dest='batchJobs', type=int, default=2, help='Number of files encoded at a time in batch mode.')
+		parser.add_argument('--retries', type=int, default=1, help='Number of retries of a failed file in batch mode.')
+		parser.add_argument('--state', help='Job state file for resuming a batch (def: OUTDIR/.VideoEncoder-batch.json).')
 		self.argsParser = parser
 		return self.argsParser
 
@@ -221,11 +573,82 @@ class VideoEncoder:
 	def close(self):
 		self.closeCurses()
 	
-	def getFfmpegCommonOpts(self):
-		opts = ['-i', self.args.infile, '-v', '0', '-ss', str(self.args.start)]
-		if self.args.duration < float('inf'):
-			opts += ['-t', str(self.args.duration)]
+	def getFfmpegCommonOpts(self, start=None, duration=None):
+		if duration == None:
+			duration = self.args.duration
+		if start == None:
+			opts = ['-i', self.args.infile, '-v', '0', '-ss', str(self.args.start)]
+			if duration < float('inf'):
+				opts += ['-t', str(duration)]
+			return opts
+
+		# Seek and limit on the input side, so that a segment does not
+		# decode the whole input before it, and the range applies to all the
+		# outputs.
+		opts = ['-ss', '%.6f' % start]
+		if duration < float('inf'):
+			opts += ['-t', '%.6f' % duration]
+		opts += ['-i', self.args.infile, '-v', '0']
 		return opts
+
+	def getKeyframeTimes(self, file):
+		# Packet flags are read without decoding the video.
+		cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+		       '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', file]
+		try:
+			out = subprocess.check_output(cmd)
+		except subprocess.CalledProcessError as e:
+			raise SubprocessFailedError('ffprobe failed with return code %d.' % e.returncode)
+		times = [ ]
+		for line in out.decode('utf-8').splitlines():
+			fields = line.split(',')
+			if len(fields) >= 2 and 'K' in fields[1] and fields[0] not in ('', 'N/A'):
+				times.append(float(fields[0]))
+		times.sort()
+		return times
+
+	def getSegments(self, count):
+		"""
+		Splits the time range to encode into up to count segments starting
+		at keyframes, and returns the list of (ffmpegCommonOpts, estimated
+		frame count).
+		"""
+		start = self.args.start
+		end = start + self.args.duration
+		fileDuration = self.mi['General']['Duration']
+		if fileDuration != '':
+			end = min(end, float(fileDuration) / 1000)
+		if end == float('inf'):
+			raise MediaFileNotSupportedError('Cannot split media file of unknown duration into segments.')
+
+		# The frame rate gives the progress total and the cut margin.
+		frameRate = self.mi['Video']['FrameRate']
+		frameRate = float(frameRate) if frameRate != '' else 0
+		if frameRate <= 0:
+			raise MediaFileNotSupportedError('Cannot split media file of unknown frame rate into segments.')
+		# Cut half a frame before each keyframe so that rounding of the
+		# timestamps neither drops nor duplicates a frame at the boundaries.
+		margin = 0.5 / frameRate
+
+		keyframes = self.getKeyframeTimes(self.args.infile)
+		bounds = [start]
+		for i in range(1, count):
+			target = start + (end - start) * i / count
+			k = bisect.bisect_left(keyframes, target)
+			if k == len(keyframes) or keyframes[k] - margin >= end: break
+			if keyframes[k] - margin > bounds[-1]:
+				bounds.append(keyframes[k] - margin)
+		bounds.append(end)
+
+		segments = [ ]
+		for i in range(len(bounds) - 1):
+			duration = bounds[i+1] - bounds[i]
+			frameCount = int(round(duration * frameRate))
+			if i == len(bounds) - 2 and self.args.duration == float('inf'):
+				# Encode the last segment to the end of the input.
+				duration = float('inf')
+			segments.append((self.getFfmpegCommonOpts(bounds[i], duration), frameCount))
+		return segments
 	
 	def outputProgress(self, prefix, ypos, progress, progressTotal):
 		if self.stdscr == None: return None
@@ -257,6 +680,16 @@ class VideoEncoder:
 	
 	
 	def getMediaInfo(self, file):
+		if self.args.fastProbe:
+			# Parse the container headers in-process. Only the tags needed
+			# for encoding are queried; mediainfo is run only if the probe
+			# cannot answer them.
+			mi = mediainfo.HeaderProbe(file)
+			try:
+				return mi.queryMultiSections(mediainfo.HeaderProbe.TAGS)
+			finally:
+				mi.close()
+
 		mi = mediainfo.MediaInfo(file)
 		try:
 			tags = {
@@ -303,11 +736,7 @@ class VideoEncoder:
 				],
 			}
 			
-			result = { }
-			for cls in tags.keys():
-				result[cls] = mi.querySingleClass(cls, tags[cls])
-			
-			return result
+			return mi.queryMultiSections(tags)
 		finally:
 			mi.close()
 		
@@ -332,13 +761,75 @@ class VideoEncoder:
 
 	def logVerbose(self, s):
 		if self.args.verbose:
-			if isinstance(s, unicode): s = s.encode('utf-8')
 			sys.stdout.write(s + "\n")
 	
+	def emit(self, event, **record):
+		if self.telemetry != None:
+			self.telemetry.emit(event, **record)
+
+	def endStage(self, name, t0):
+		# Records the duration of the stage begun at t0, and returns the
+		# current time.
+		t = time.time()
+		self.stages[name] = self.stages.get(name, 0) + (t - t0)
+		self.emit('stage', stage = name, duration = t - t0)
+		return t
+
+	def getBytesWritten(self, dir):
+		# Size of the encoded data in the work directory. Named pipes are
+		# skipped.
+		total = 0
+		for name in os.listdir(dir):
+			if name in ('log', 'mediainfo'): continue
+			try:
+				st = os.stat(os.path.join(dir, name))
+			except OSError:
+				continue  # removed meanwhile
+			if stat.S_ISREG(st.st_mode):
+				total += st.st_size
+		return total
+
+	def getSpeed(self, frames, seconds):
+		# Returns (frames per second, speed relative to realtime).
+		if seconds <= 0: return (None, None)
+		fps = frames / seconds
+		frameRate = self.mi['Video'].get('FrameRate', '') if self.mi != None else ''
+		if frameRate == '': return (fps, None)
+		return (fps, fps / float(frameRate))
+
+	def emitSummary(self, error, outfile, frames, time0):
+		encodeSeconds = self.stages.get('encode', 0)
+		(fps, speed) = self.getSpeed(frames, encodeSeconds)
+		record = {
+			'status': 'ok' if self.retcode == 0 else 'failed',
+			'error': error,
+			'elapsed': time.time() - time0,
+			'stages': self.stages,
+			'frames': frames,
+			'fps': fps,
+			'speed': speed,
+		}
+		if self.retcode == 0:
+			record['outputBytes'] = os.path.getsize(outfile)
+		self.emit('summary', **record)
+
 	def run(self, args):
 		self.args = args
 		tmp = None
+		mp4TempOut = None
+		running = [ ]  # executors and processes to kill on failure
 		self.retcode = 1
+		self.stages = { }
+		error = None
+		videoFrame = 0
+		runTime0 = time.time()
+		if self.args.telemetry != None:
+			try:
+				self.telemetry = Telemetry(self.args.telemetry, {'infile': self.args.infile})
+			except (IOError, OSError, ValueError) as e:
+				# As in Telemetry.emit(), losing the telemetry must not
+				# fail the encode.
+				sys.stderr.write('Telemetry disabled: %s\n' % e)
 
 		try:
 			# Check for validity of command-line options.
@@ -358,17 +849,19 @@ class VideoEncoder:
 			
 			tmp = tempfile.mkdtemp(prefix = 'VideoEncoder_')
 			logfile = open(os.path.join(tmp, 'log'), 'w')
-			logfile.write("infile: %s\n" % infile.encode('utf-8'))
+			logfile.write("infile: %s\n" % infile)
 			
 			# Retrieve media information.
 			
 			self.logVerbose("Retrieving media information...")
+			t = time.time()
 			self.mi = self.getMediaInfo(infile)
+			t = self.endStage('probe', t)
 			with open(os.path.join(tmp, 'mediainfo'), 'w') as fp:
-				for sec, m in self.mi.iteritems():
-					for tag, v in m.iteritems():
-						fp.write("%s.%s : \"%s\"\n" % (sec, tag, v.encode('utf-8')))
-						sys.stdout.write("%s.%s : \"%s\"\n" % (sec, tag, v.encode('utf-8')))						
+				for sec, m in self.mi.items():
+					for tag, v in m.items():
+						fp.write("%s.%s : \"%s\"\n" % (sec, tag, v))
+						sys.stdout.write("%s.%s : \"%s\"\n" % (sec, tag, v))						
 			
 			videoCount = self.mi["General"]["VideoCount"]
 			audioCount = self.mi["General"]["AudioCount"]
@@ -390,10 +883,18 @@ class VideoEncoder:
 			
 			# Prepare for encoding.
 			
-			mp4TempOut = os.path.join(tmp, 'out.mp4')
+			# The MP4 is written next to the output file so that it can be
+			# renamed into place.
+			outdir, outname = os.path.split(os.path.abspath(outfile))
+			mp4TempOut = os.path.join(outdir, '.%s.VideoEncoder.tmp.mp4' % outname)
 
 			videoEnable = (videoCount == 1)
 			audioEnable = (audioCount == 1) and not self.args.noAudio
+
+			videoThreads = self.args.threads
+			if videoThreads != None and audioEnable and videoThreads > 1:
+				# faac is single-threaded; leave one CPU to it.
+				videoThreads -= 1
 			
 			# Begin encoding.
 			
@@ -401,21 +902,46 @@ class VideoEncoder:
 			self.logVerbose('Begin encoding.')
 			videoExec = None
 			audioExec = None
+			muxProc = None
+			videoTempOut = os.path.join(tmp, 'video.264')
+			audioTempOut = os.path.join(tmp, 'audio.aac')
+			muxTempOut = os.path.join(tmp, 'mux.mp4')
 
-			if videoEnable:
-				videoTempOut = os.path.join(tmp, 'video.264')
-				videoExec = VideoEncodeExecutor(infile, videoTempOut, self.mi, self.getFfmpegCommonOpts())
-				videoExec.start()
-			
-			if audioEnable:
-				audioTempOut = os.path.join(tmp, 'audio.aac')
-				audioExec = AudioEncodeExecutor(infile, audioTempOut, self.mi, self.getFfmpegCommonOpts())
-				audioExec.start()
+			if self.args.pipeline:
+				if self.args.segments > 1:
+					raise VideoEncoderError('--pipeline cannot be used with --segments.')
+				if not encoderBackends[self.args.backend].supportsPipeline:
+					raise VideoEncoderError('--pipeline cannot be used with backend %s.' % self.args.backend)
+				# The encoders write to named pipes which the muxer reads
+				# while they are encoding.
+				if videoEnable: os.mkfifo(videoTempOut)
+				if audioEnable: os.mkfifo(audioTempOut)
+				muxProc = self.startMuxer(
+					videoTempOut if videoEnable else None,
+					audioTempOut if audioEnable else None,
+					muxTempOut)
+				running.append(muxProc)
+
+			backend = encoderBackends[self.args.backend]()
+			(videoExec, audioExec) = backend.createExecutors(
+				self,
+				videoTempOut if videoEnable else None,
+				audioTempOut if audioEnable else None,
+				videoThreads)
+			# The loop below wakes up when an executor reports progress or
+			# exits. The muxer is checked at least every progressInterval.
+			updated = threading.Event()
+			executors = [e for e in (videoExec, audioExec) if e != None]
+			for executor in executors:
+				executor.setUpdateEvent(updated)
+				executor.start()
+				running.append(executor)
 			
 			# Loop until encode finishes.
 			
-			videoFrame = 0
 			time0 = time.time()
+			lastOutput = None
+			muxExitTime = None
 
 			#--------------------
 			# Decode video/audio
@@ -429,26 +955,46 @@ class VideoEncoder:
 				#  Return code is None if the process is running, negative if the process is terminated by 
 				#  signal abs(return code).
 				
-				elapsedSeconds = time.time() - time0
+				updated.clear()
+				now = time.time()
+				output = lastOutput == None or now - lastOutput >= self.progressInterval
+				if output:
+					lastOutput = now
+				elapsedSeconds = now - time0
 				if progressRatio > 0:
 					remSeconds = elapsedSeconds * (1-progressRatio) / progressRatio
 				else:
 					remSeconds = 0
-				if self.stdscr != None:
+				if not output:
+					pass
+				elif self.stdscr != None:
 					(h, w) = self.stdscr.getmaxyx()
 					self.stdscr.move(h-1, 0)
 					self.stdscr.clrtoeol()
 					self.stdscr.addstr('Elap: %.1f %s  Rem: %.1f %s' % (self.secondsToHumanReadable(elapsedSeconds) + self.secondsToHumanReadable(remSeconds)))
 					self.stdscr.refresh()
 				else:
-					sys.stdout.write('Elap: %.1f %s  Rem: %.1f %s' % (self.secondsToHumanReadable(elapsedSeconds) + self.secondsToHumanReadable(remSeconds)) + "\n")
+					sys.stdout.write('Elap: %.1f %s  Rem: %.1f %s' % (self.secondsToHumanReadable(elapsedSeconds) + self.secondsToHumanReadable(remSeconds)) + '  Prog: %.1f%%' % (progressRatio * 100) + "\n")
+					sys.stdout.flush()
+				if output and self.telemetry != None:
+					(fps, speed) = self.getSpeed(videoFrame, elapsedSeconds)
+					self.emit('progress',
+						elapsed = elapsedSeconds,
+						frames = videoFrame,
+						progress = progressRatio,
+						fps = fps,
+						speed = speed,
+						eta = remSeconds if progressRatio > 0 else None,
+						bytesWritten = self.getBytesWritten(tmp))
 				
 				# video
 				if videoExec != None:
 					ret = videoExec.getReturnCode()
 					if ret == None:
 						(progress, progressTotal) = videoExec.getProgress()
-						self.outputProgress('V: ', 1, progress, progressTotal)
+						videoFrame = progress
+						if output:
+							self.outputProgress('V: ', 1, progress, progressTotal)
 						if progressTotal != None:
 							progressRatio = float(progress) / progressTotal
 						else:
@@ -459,6 +1005,7 @@ class VideoEncoder:
 							self.logVerbose('Video encoding done.')
 						if ret != 0:
 							raise SubprocessFailedError('Video encoder failed with return code %d.' % ret)
+						videoFrame = videoExec.getProgress()[0]
 						videoExec = None
 						
 				
@@ -467,7 +1014,8 @@ class VideoEncoder:
 					ret = audioExec.getReturnCode()
 					if ret == None:
 						(progress, progressTotal) = audioExec.getProgress()
-						self.outputProgress('A: ', 2, progress, progressTotal)
+						if output:
+							self.outputProgress('A: ', 2, progress, progressTotal)
 					else:
 						# audio finishes
 						if self.stdscr == None:
@@ -477,24 +1025,51 @@ class VideoEncoder:
 							raise SubprocessFailedError('Audio encoder faled with return code %d.' % ret)
 						audioExec = None
 				
+				# muxer
+				if muxProc != None:
+					ret = muxProc.poll()
+					if ret != None and ret != 0:
+						raise SubprocessFailedError('Muxer failed with return code %d.' % ret)
+					if ret != None and (videoExec != None or audioExec != None):
+						# The muxer exits on EOF, just before the encoders do.
+						# Encoders still running after that would wait for a
+						# reader of the pipes forever.
+						if muxExitTime == None:
+							muxExitTime = now
+						elif now - muxExitTime > self.muxerExitTimeout:
+							raise SubprocessFailedError('Muxer exited before the encoders finished.')
+
 				# If both video and audio finish, exit the loop.
 				if audioExec == None and videoExec == None:
 					break
 				
-				time.sleep(0.5)
+				updated.wait(self.progressInterval)
 			
 			self.closeCurses()
+			for executor in executors:
+				executor.finish()
+			t = self.endStage('encode', time0)
 
 			#----------------
 			# MP4 mux
 			#----------------
 
-			if videoEnable:
+			# Everything is muxed and hinted in one MP4Box invocation, which
+			# writes the output once. MP4Box is run in the temporary
+			# directory, without which hinting fails.
+			opts = [ ]
+			inPath = None
+			if muxProc != None:
+				# Already muxed while encoding; only hint.
+				ret = muxProc.wait()
+				if ret != 0:
+					raise SubprocessFailedError('Muxer failed with return code %d.' % ret)
+				inPath = muxTempOut
+				t = self.endStage('mux', t)
+			elif videoEnable:
 				trackId = 1
 				videoWidth  = int(self.mi['Video']['Width'])
 				videoHeight = int(self.mi['Video']['Height'])
-				opts = [ ]
-				opts += ['-new']
 				opts += ['-add', videoTempOut]
 				opts += ['-fps', self.mi["Video"]["FrameRate"]]
 
@@ -506,45 +1081,26 @@ class VideoEncoder:
 						opts += [ '-par', '%d=%s' % (trackId,dar) ]
 				except ValueError:
 					pass
-
-				ret = self.execMP4Box(opts, mp4TempOut, mp4TempOut)
-				if ret != 0:
-					raise SubprocessFailedError("Video muxing failed with return code %d." % ret)
 				videoExec = None
 
-
-			if audioEnable:
-				opts = ['-add', audioTempOut]
-				ret = self.execMP4Box(opts, mp4TempOut, mp4TempOut)
-				if ret != 0:
-					raise SubprocessFailedError("Audio muxing failed with return code %d." % ret)
+			if audioEnable and muxProc == None:
+				opts += ['-add', audioTempOut]
 				audioExec = None
 
-			sys.stdout.write('MP4 muxing is done.' + "\n")
+			opts += ['-hint']
+			ret = self.execMP4Box(opts, mp4TempOut, tmp, inPath)
+			if ret != 0:
+				raise SubprocessFailedError("MP4 muxing failed with return code %d." % ret)
+			# Without the pipeline, hinting is done by the muxing invocation.
+			t = self.endStage('hint' if inPath != None else 'mux', t)
 
-			#-------------------
-			# MP4 optimization
-			#-------------------
-			# Note: Without changing working directory, this will fail.
-			
-			prevcwd = os.getcwd()
-			try:
-				self.logVerbose("cd'ing '%s'\n" % tmp)
-				os.chdir(tmp)
-				
-				ret = self.execMP4Box(['-hint'], mp4TempOut, mp4TempOut)
-				if ret != 0:
-					raise SubprocessFailedError("MP4Box failed with return code %d." % ret)
-
-			finally:
-				self.logVerbose("cd'ing '%s'\n" % prevcwd)
-				os.chdir(prevcwd)
+			sys.stdout.write('MP4 muxing is done.' + "\n")
 
-			# Move resulted file.
+			# Move resulted file. It is in the same directory, so this is a rename.
 			
-			#shutil.move(mp4TempOut, outfile)
 			self.logVerbose("Moving...")
-			shutil.move(mp4TempOut, outfile)
+			os.rename(mp4TempOut, outfile)
+			mp4TempOut = None
 			
 			# Show new media information.
 			
@@ -580,23 +1136,40 @@ class VideoEncoder:
 					float(self.mi["General"]["FileSize"]) / 1024 / 1024,
 					float(     mi["General"]["FileSize"]) / 1024 / 1024,
 				))
+			t = self.endStage('verify', t)
 
 			self.retcode = 0
 		except KeyboardInterrupt as e:
+			error = 'Interrupted.'
 			raise
 		except InsufficientOptionParametersError as e:
-			print("Option %s requires more parameters." % e)
+			error = "Option %s requires more parameters." % e
+			print(error)
 		except InvalidOptionError as e:
-			print("Unknown option: %s" % e)
+			error = "Unknown option: %s" % e
+			print(error)
 		except MediaFileNotSupportedError as e:
+			error = str(e)
 			print(e)
 		except InsufficientOptionsError as e:
+			error = str(e)
 			print(e)
 		except VideoEncoderError as e:
+			error = str(e)
 			print(e)
 		except CancelByUserError as e:
-			pass
+			error = 'Cancelled by user.'
 		finally:
+			if self.telemetry != None:
+				self.emitSummary(error, self.args.outfile, videoFrame, runTime0)
+				self.telemetry.close()
+				self.telemetry = None
+			# Processes left after a failure; with named pipes they could
+			# otherwise wait for each other forever.
+			for r in running:
+				r.kill()
+			if mp4TempOut != None and os.path.exists(mp4TempOut):
+				os.remove(mp4TempOut)
 			if tmp != None:
 				try:
 					shutil.rmtree(tmp)
@@ -605,30 +1178,271 @@ class VideoEncoder:
 				pass
 		return self.retcode
 
-	def execMP4Box(self, opts, inPath, outPath):
+	def execMP4Box(self, opts, outPath, cwd, inPath=None):
 		# Note:
 		# MP4Box will fail if the output file and the temporary file (which MP4Box creates) lie in different partition.
+		# Its temporary files are therefore put in the directory of the output file.
 		
-		tmpOut = tempfile.NamedTemporaryFile(suffix = '.mp4')
-		
-		cmd = ['MP4Box', inPath]
+		cmd = ['MP4Box']
+		if inPath != None:
+			cmd += [inPath]
 		cmd += opts
-		cmd += [ '-out', tmpOut.name ]
-		ret = subprocess.call(cmd)
-		if ret != 0:
-			return ret
-		shutil.copyfile(tmpOut.name, outPath)
-		return 0
+		cmd += ['-tmp', os.path.dirname(outPath)]
+		cmd += ['-out' if inPath != None else '-new', outPath]
+		return subprocess.call(cmd, cwd = cwd)
+
+	def startMuxer(self, videoPath, audioPath, outPath):
+		# Muxes the raw H.264 and ADTS AAC streams without re-encoding. The
+		# inputs may be named pipes; ffmpeg reads whichever the interleaving
+		# needs, so neither encoder is blocked for long.
+		cmd = ['ffmpeg', '-v', 'error', '-y']
+		if videoPath != None:
+			cmd += ['-f', 'h264', '-framerate', self.mi['Video']['FrameRate'], '-i', videoPath]
+		if audioPath != None:
+			cmd += ['-f', 'aac', '-i', audioPath]
+		for i in range(len([p for p in (videoPath, audioPath) if p != None])):
+			cmd += ['-map', str(i)]
+		cmd += ['-c', 'copy']
+		if videoPath != None:
+			try:
+				numDen = self.aspectRatioFloatToTuple(self.mi['Video']['DisplayAspectRatio'])
+				if numDen != None:
+					cmd += ['-aspect', '%d:%d' % numDen]
+			except ValueError:
+				pass
+		cmd += ['-f', 'mp4', outPath]
+		devnull = open(os.devnull, 'rb')
+		try:
+			return subprocess.Popen(cmd, stdin = devnull, shell = False)
+		finally:
+			devnull.close()
 
 	def aspectRatioFloatToTuple(self, ar):
-		assert(isinstance(ar, str) or isinstance(ar, unicode))
+		assert(isinstance(ar, str))
 		idot = ar.find('.')
 		numDigitsBelowDot = len(ar) - idot - 1
 		fmt = '%%.%df' % numDigitsBelowDot
 		
-		for num in xrange(1,10):
-			for den in xrange(1,10):
+		for num in range(1,10):
+			for den in range(1,10):
 				ar2 = fmt % (float(num) / den)
 				if ar == ar2:
 					return (num, den)
 		return None
+
+
+class BatchJob:
+	def __init__(self, infile, state):
+		self.infile = infile
+		self.state = state  # dict stored in the job state file
+		self.proc = None
+		self.progressRatio = 0
+		self.lastLine = ''
+
+	def start(self, cmd):
+		devnull = open(os.devnull, 'rb')
+		self.proc = subprocess.Popen(cmd, stdin = devnull, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, shell = False)
+		devnull.close()
+		self.progressRatio = 0
+		t = threading.Thread(target = self.readerThread, args=(self.proc.stdout,))
+		t.daemon = True
+		t.start()
+
+	def readerThread(self, fp):
+		for line in iter(fp.readline, b''):
+			line = line.rstrip()
+			match = BatchEncoder.progressPattern.search(line)
+			if match != None:
+				self.progressRatio = float(match.group(1)) / 100
+			elif len(line) > 0:
+				self.lastLine = line
+
+	def getReturnCode(self):
+		if self.proc == None: return None
+		return self.proc.poll()
+
+
+class BatchEncoder:
+	"""
+	Encodes many files, running each one as a child process of this script.
+	The state of the jobs is saved to a JSON file after each change, so that
+	an interrupted batch is resumed by running the same command again.
+	"""
+	progressPattern = re.compile(br'Prog: *([\d.]+)%')
+	extensions = set(['.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi', '.wmv', '.flv', '.mpg', '.mpeg', '.ts', '.m2ts', '.3gp'])
+
+	def __init__(self, args):
+		self.args = args
+		self.outdir = args.outfile
+		self.statePath = args.state or os.path.join(self.outdir, '.VideoEncoder-batch.json')
+		self.jobs = { }  # infile -> state
+
+	def getInputs(self):
+		# Returns the list of (infile, outfile). A default outfile which is
+		# already used by another input gets a numbered suffix; the jobs of
+		# the loaded state keep theirs.
+		src = self.args.batch
+		if os.path.isdir(src):
+			names = sorted(os.listdir(src))
+			lines = [os.path.join(src, name) for name in names if os.path.splitext(name)[1].lower() in self.extensions]
+		else:
+			with open(src) as f:
+				lines = [line.rstrip('\n') for line in f]
+
+		entries = [ ]  # (infile, outfile or None for the default)
+		for line in lines:
+			if line.strip() == '' or line.startswith('#'): continue
+			fields = line.split('\t')
+			infile = fields[0]
+			if infile in self.jobs:
+				entries.append((infile, self.jobs[infile]['outfile']))
+			elif len(fields) > 1 and fields[1] != '':
+				entries.append((infile, fields[1]))
+			else:
+				entries.append((infile, None))
+
+		owners = { }  # normalized outfile -> infile
+		def claim(infile, outfile):
+			key = os.path.normcase(os.path.abspath(outfile))
+			if owners.setdefault(key, infile) != infile:
+				return owners[key]
+			return None
+		for infile, state in self.jobs.items():
+			claim(infile, state['outfile'])
+		for infile, outfile in entries:
+			if outfile != None:
+				other = claim(infile, outfile)
+				if other != None:
+					raise VideoEncoderError('Output file %s is given to both %s and %s.' % (outfile, other, infile))
+
+		inputs = [ ]
+		for infile, outfile in entries:
+			if outfile == None:
+				base = os.path.join(self.outdir, os.path.splitext(os.path.basename(infile))[0])
+				outfile = base + '.mp4'
+				n = 0
+				while claim(infile, outfile) != None:
+					n += 1
+					outfile = '%s-%d.mp4' % (base, n)
+			inputs.append((infile, outfile))
+		return inputs
+
+	def loadState(self):
+		if os.path.isfile(self.statePath):
+			with open(self.statePath) as f:
+				self.jobs = json.load(f)['jobs']
+
+	def saveState(self):
+		tmpPath = self.statePath + '.tmp'
+		with open(tmpPath, 'w') as f:
+			json.dump({'jobs': self.jobs}, f, indent=1, sort_keys=True)
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(tmpPath, self.statePath)
+
+	def getJobCommand(self, state, threads):
+		args = self.args
+		cmd = [sys.executable, '-u', os.path.abspath(__file__), '--infile', state['infile'], '--outfile', state['outfile'], '--force']
+		cmd += ['--threads', str(threads)]
+		if args.start != 0: cmd += ['--start', str(args.start)]
+		if args.duration < float('inf'): cmd += ['--duration', str(args.duration)]
+		if args.noAudio: cmd += ['--noaudio']
+		if args.fastProbe: cmd += ['--fastprobe']
+		if args.segments > 1: cmd += ['--segments', str(args.segments)]
+		if args.jobs != None: cmd += ['--jobs', str(args.jobs)]
+		if args.pipeline: cmd += ['--pipeline']
+		if args.telemetry != None: cmd += ['--telemetry', args.telemetry]
+		cmd += ['--backend', args.backend]
+		return cmd
+
+	def outputProgress(self, running):
+		states = self.jobs.values()
+		done = len([s for s in states if s['status'] == 'done'])
+		failed = len([s for s in states if s['status'] == 'failed'])
+		ratio = (done + failed + sum(job.progressRatio for job in running)) / float(max(1, len(states)))
+		line = '[%d/%d done, %d failed] %5.1f%%' % (done, len(states), failed, ratio * 100)
+		for job in running:
+			line += '  %s:%5.1f%%' % (os.path.basename(job.infile), job.progressRatio * 100)
+		sys.stdout.write(line + "\n")
+		sys.stdout.flush()
+
+	def run(self):
+		self.loadState()
+		inputs = self.getInputs()
+		if not os.path.isdir(self.outdir):
+			os.makedirs(self.outdir)
+		for infile, outfile in inputs:
+			state = self.jobs.setdefault(infile, {'infile': infile, 'outfile': outfile, 'status': 'pending', 'attempts': 0})
+			if state['status'] != 'done':
+				# Also retry the jobs interrupted by a crash.
+				state['status'] = 'pending'
+				state['attempts'] = 0
+		self.saveState()
+
+		pending = [s for s in self.jobs.values() if s['status'] == 'pending']
+		pending.sort(key = lambda s: s['infile'], reverse = True)
+		maxJobs = max(1, self.args.batchJobs)
+		threads = max(1, (self.args.threads or multiprocessing.cpu_count()) // maxJobs)
+		running = [ ]
+		try:
+			while len(pending) > 0 or len(running) > 0:
+				while len(running) < maxJobs and len(pending) > 0:
+					state = pending.pop()
+					state['status'] = 'running'
+					state['attempts'] += 1
+					self.saveState()
+					job = BatchJob(state['infile'], state)
+					job.start(self.getJobCommand(state, threads))
+					running.append(job)
+
+				for job in list(running):
+					ret = job.getReturnCode()
+					if ret == None: continue
+					running.remove(job)
+					state = job.state
+					if ret == 0 and os.path.isfile(state['outfile']):
+						state['status'] = 'done'
+						state.pop('error', None)
+					elif state['attempts'] <= self.args.retries:
+						state['status'] = 'pending'
+						state['error'] = job.lastLine.decode('utf-8', 'replace')
+						pending.insert(0, state)
+					else:
+						state['status'] = 'failed'
+						state['error'] = job.lastLine.decode('utf-8', 'replace')
+					self.saveState()
+
+				self.outputProgress(running)
+				time.sleep(0.5)
+		finally:
+			for job in running:
+				if job.getReturnCode() == None:
+					job.proc.kill()
+
+		failed = [s for s in self.jobs.values() if s['status'] == 'failed']
+		for state in failed:
+			print('Failed: %s: %s' % (state['infile'], state.get('error', '')))
+		return 1 if len(failed) > 0 else 0
+
+
+def main(argv=None):
+	encoder = VideoEncoder()
+	parser = encoder.getArgumentParser()
+	args = parser.parse_args(argv)
+	if args.batch != None:
+		if args.outfile == None:
+			parser.error('--outfile (output directory) is required in batch mode.')
+		try:
+			return BatchEncoder(args).run()
+		except VideoEncoderError as e:
+			print(e)
+			return 1
+	if args.infile == None or args.outfile == None:
+		parser.error('--infile and --outfile are required.')
+	try:
+		return encoder.run(args)
+	finally:
+		encoder.close()
+
+if __name__ == '__main__':
+	sys.exit(main())
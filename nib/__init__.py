@@ -50,18 +50,12 @@ def makeRelativePath(targetPath, sourcePath):
     return os.path.join(*parts1)
 
 def md5(path, file=True):
-    m = hashlib.md5()
-
     if file:
-        f = open(encodePath(path), 'rb')
-        while True:
-            data = f.read(8192)
-            if not data: break
-            m.update(data)
-        f.close()
-    else:
-        m.update(path)
+        return hash_file(path, 'md5')
 
+    # path can be any buffer-protocol object or an iterable of them.
+    m = hashlib.md5()
+    update_from_buffers(m, path)
     return m.hexdigest()
 
 def mkdir(path, mode=None, **kwargs):
@@ -146,7 +140,8 @@ class ExtraLogFilter(logging.Filter):
 
         return super().filter(record)
 
-from .async_ import (Async, BindingAsync)
+from .async_ import (Async, BindingAsync, AsyncExecutor, CancellationToken, TaskScheduler, enable_metrics, disable_metrics)
+from .hashing import (hash_file, hash_files, find_duplicates, update_from_buffers, Hasher, DigestCache)
 
 class ColorFormatter(logging.Formatter):
     RESET = "\033[0m"
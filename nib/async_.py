@@ -1,96 +1,685 @@
+import os
+import abc
+import time
+import asyncio
+import heapq
+import queue
+import json
+import itertools
 import threading
+import collections
+import traceback
 import multiprocessing
+import concurrent.futures
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
+DEFAULT_MAX_QUEUE = 1024
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+_metrics = None
+
+
+def enable_metrics(metrics=None):
+    """
+    Starts recording metrics of all Async tasks. Returns the AsyncMetrics.
+    """
+    global _metrics
+    if metrics is None:
+        metrics = AsyncMetrics()
+    _metrics = metrics
+    return metrics
+
+
+def disable_metrics():
+    global _metrics
+    _metrics = None
+
+
+def get_metrics():
+    """
+    Returns the AsyncMetrics being recorded, or None if disabled.
+    """
+    return _metrics
+
+
+class Histogram(object):
+    """
+    Histogram of durations in seconds, with power-of-two buckets from 1us.
+    """
+    MIN_BOUND = 1e-6
+    NUM_BUCKETS = 32
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * self.NUM_BUCKETS
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        bound = self.MIN_BOUND
+        i = 0
+        while value > bound and i < self.NUM_BUCKETS - 1:
+            bound *= 2
+            i += 1
+        self.buckets[i] += 1
+
+    def snapshot(self):
+        buckets = {}
+        bound = self.MIN_BOUND
+        for i, n in enumerate(self.buckets):
+            if n > 0:
+                key = 'inf' if i == self.NUM_BUCKETS - 1 else '{:.6g}'.format(bound)
+                buckets[key] = n
+            bound *= 2
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count > 0 else None,
+            'min': self.min,
+            'max': self.max,
+            'buckets': buckets,  # upper bound (seconds) -> count
+        }
+
+
+class AsyncMetrics(object):
+    """
+    Counters, duration histograms and trace events of Async tasks.
+
+    queue_time:   from scheduling (start()) to the start of the target
+    run_time:     from the start of the target to its completion
+    handler_time: time spent in the handlers of a task
+
+    For tasks on a process pool, the target is considered started when it
+    is submitted.
+    """
+
+    def __init__(self, max_events=100000):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.counters = collections.OrderedDict([
+            ('started', 0),
+            ('finished', 0),
+            ('failed', 0),
+            ('cancelled', 0),
+        ])
+        self.histograms = collections.OrderedDict([
+            ('queue_time', Histogram()),
+            ('run_time', Histogram()),
+            ('handler_time', Histogram()),
+        ])
+        self.running = 0
+        self.max_running = 0
+        self.events = collections.deque(maxlen=max_events)
+
+    def task_started(self, asy):
+        with self.lock:
+            self.counters['started'] += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            if asy.schedule_time is not None:
+                self.histograms['queue_time'].add(asy.begin_time - asy.schedule_time)
+
+    def task_completed(self, asy, end_time):
+        with self.lock:
+            if asy.begin_time is not None:
+                self.running -= 1
+            if isinstance(asy.exception, concurrent.futures.CancelledError):
+                self.counters['cancelled'] += 1
+            elif asy.error:
+                self.counters['failed'] += 1
+            else:
+                self.counters['finished'] += 1
+            if asy.begin_time is None:
+                return
+            self.histograms['run_time'].add(end_time - asy.begin_time)
+            event = {
+                'name': asy.name,
+                'cat': 'async',
+                'ph': 'X',
+                'ts': asy.begin_time * 1e6,
+                'dur': (end_time - asy.begin_time) * 1e6,
+                'pid': self.pid,
+                'tid': threading.get_ident(),
+                'args': {'error': repr(asy.exception) if asy.error else None},
+            }
+            if asy.schedule_time is not None:
+                event['args']['queue_time'] = asy.begin_time - asy.schedule_time
+            self.events.append(event)
+
+    def handlers_called(self, asy, begin_time, end_time):
+        with self.lock:
+            self.histograms['handler_time'].add(end_time - begin_time)
+            self.events.append({
+                'name': '{} (handlers)'.format(asy.name),
+                'cat': 'handler',
+                'ph': 'X',
+                'ts': begin_time * 1e6,
+                'dur': (end_time - begin_time) * 1e6,
+                'pid': self.pid,
+                'tid': threading.get_ident(),
+            })
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {key: h.snapshot() for key, h in self.histograms.items()},
+                'running': self.running,
+                'max_running': self.max_running,
+                'live_threads': threading.active_count(),
+            }
+
+    def get_trace_events(self):
+        with self.lock:
+            return list(self.events)
+
+    def write_chrome_trace(self, path):
+        """
+        Writes the trace events in the Chrome trace event format, which can
+        be loaded in chrome://tracing.
+        """
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.get_trace_events(), 'displayTimeUnit': 'ms'}, f)
+
+
+def get_default_executor():
+    """
+    Returns the executor shared by Async objects, creating it on first use.
+    """
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = AsyncExecutor(max_queue=DEFAULT_MAX_QUEUE)
+        return _default_executor
+
+
+def set_default_executor(executor):
+    global _default_executor
+    with _default_executor_lock:
+        _default_executor = executor
+
+
+class _Timer(object):
+    """
+    Single thread which runs delayed calls, shared by all timeouts.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.heap = []
+        self.counter = itertools.count()
+        self.thread = None
+
+    def schedule(self, delay, func):
+        """
+        Returns a handle which can be passed to cancel().
+        """
+        entry = [time.monotonic() + delay, next(self.counter), func]
+        with self.cond:
+            heapq.heappush(self.heap, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='AsyncTimer')
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self.cond:
+            entry[2] = None
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if len(self.heap) == 0:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        entry = heapq.heappop(self.heap)
+                        func = entry[2]
+                        break
+                    self.cond.wait(delay)
+            if func is not None:
+                try:
+                    func()
+                except Exception:
+                    logger.exception("Timer callback failed.")
+
+
+_timer = _Timer()
+
+
+class CancellationToken(object):
+    """
+    Cooperative cancellation flag. Targets of cancellable Asyncs receive it
+    as the cancel_token keyword argument, and should check it regularly.
+    A token can be shared by several Asyncs to cancel them together.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        self.event.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits until cancelled. Returns True if cancelled.
+        """
+        return self.event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise concurrent.futures.CancelledError()
+
+
+def _schedule_on_loop(handler, loop):
+    if loop is None:
+        return handler
+
+    def f(*args):
+        loop.call_soon_threadsafe(handler, *args)
+    return f
+
+
+def _set_future_outcome(future, asy):
+    if future.done():
+        return
+    if asy.error:
+        future.set_exception(asy.exception)
+    else:
+        future.set_result(asy.result)
+
+
+def _call_in_process(target, args):
+    return multiprocessing.current_process().name, target(*args)
+
+
+class AsyncExecutor(object):
+    """
+    Runs Async objects on a bounded thread pool, or on a process pool if
+    they are created with use_process=True.
+
+    max_queue: maximum number of tasks waiting for a worker, per pool.
+               submit() blocks (or raises queue.Full if block=False) while
+               the queue is full. None means unlimited.
+    max_processes: size of the process pool, which is created on first use.
+    """
+
+    def __init__(self, max_workers=None, max_queue=None, max_processes=None):
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        if max_processes is None:
+            max_processes = os.cpu_count() or 1
+        self.max_workers = max_workers
+        self.max_processes = max_processes
+        self.max_queue = max_queue
+        self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='Async')
+        self.process_pool = None
+        self.lock = threading.Lock()
+        if max_queue is None:
+            self.thread_slots = None
+            self.process_slots = None
+        else:
+            self.thread_slots = threading.BoundedSemaphore(max_workers + max_queue)
+            self.process_slots = threading.BoundedSemaphore(max_processes + max_queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+
+    def get_process_pool(self):
+        with self.lock:
+            if self.process_pool is None:
+                self.process_pool = concurrent.futures.ProcessPoolExecutor(self.max_processes)
+            return self.process_pool
+
+    def shutdown(self, wait=True):
+        self.thread_pool.shutdown(wait)
+        with self.lock:
+            if self.process_pool is not None:
+                self.process_pool.shutdown(wait)
+
+    def submit(self, asy, block=True, timeout=None):
+        assert not asy.started and asy.future is None
+        assert not asy.pass_cancel_token or not asy.use_process, "Cancellation tokens cannot be passed to other processes."
+        asy.schedule_time = time.perf_counter()
+        slots = self.process_slots if asy.use_process else self.thread_slots
+        if slots is not None and not slots.acquire(block, timeout):
+            raise queue.Full("Async queue is full: {}".format(self.max_queue))
+
+        if not asy.use_process:
+            try:
+                future = self.thread_pool.submit(asy.run)
+            except Exception:
+                if slots is not None:
+                    slots.release()
+                raise
+            asy.future = future
+            asy.scheduled = True
+            if slots is not None:
+                future.add_done_callback(lambda f: slots.release())
+            return
+
+        # The target runs in a worker process; handlers run in this process
+        # once the result arrives.
+        args = asy.begin()
+        try:
+            future = self.get_process_pool().submit(_call_in_process, asy.target, args)
+        except Exception:
+            if slots is not None:
+                slots.release()
+            raise
+        asy.future = future
+        asy.scheduled = True
+
+        def on_done(f):
+            try:
+                try:
+                    process_name, res = f.result()
+                except Exception as e:
+                    asy.complete(None, e)
+                else:
+                    asy.process_name = process_name
+                    asy.complete(res, None)
+            finally:
+                if slots is not None:
+                    slots.release()
+
+        future.add_done_callback(on_done)
+
+
 class Async(object):
-    def __init__(self, target=None, args=None, print_on_error=False, keep=None):
+    def __init__(self, target=None, args=None, print_on_error=False, keep=None, executor=None, use_process=False,
+                 cancellable=False, cancel_token=None, name=None):
         """
+        name: name of the task in metrics. Defaults to the name of target.
         keep: any object to avoid GC
+        executor: AsyncExecutor to run on. If omitted, start() runs the
+                  target on a new thread.
+        use_process: run the target on the process pool of the executor
+                     (the default executor if omitted). The target and args
+                     must be picklable. Handlers run in this process.
+        cancellable: pass a CancellationToken to target as the cancel_token
+                     keyword argument.
+        cancel_token: CancellationToken to pass to target, e.g. one shared
+                      with other Asyncs. Implies cancellable.
         """
         self.target = target
         self.args = args
         self.started = False
         self.finished = False
         self.error = False
+        self.exception = None
         self.result = None
         self.print_on_error = print_on_error
         self.handlers_on_success = []
         self.handlers_on_error = []
         self.handlers_on_done = []
         self.thread = None
+        self.future = None
         self.process_name = "<unknown>"
         self.keep = keep
+        if name is None:
+            name = getattr(target, '__name__', self.__class__.__name__)
+        self.name = name
+        self.schedule_time = None
+        self.begin_time = None
+        self.executor = executor
+        self.use_process = use_process
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.completing = False
+        self.done_handlers_called = False
+        self.done_event = threading.Event()
+        self.pass_cancel_token = cancellable or cancel_token is not None
+        self.cancel_token = cancel_token if cancel_token is not None else CancellationToken()
+
+    # The combinators below use no threads of their own: they are driven by
+    # the done handlers of their inputs, which must be started separately.
+    # Like any Async, the returned object must be started to take effect.
 
     @classmethod
     def from_asyncs(cls, asyncs, **kwargs):
-        def target():
-            results = []
-            for asy in asyncs:
-                results.append(asy.get())
-            return results
-
-        return cls(target=target, **kwargs)
+        return BindingAsync(asyncs, **kwargs)
 
     @classmethod
     def from_futures(cls, futures, **kwargs):
-        def target():
-            results = []
-            for future in futures:
-                results.append(future.result())
-            return results
+        asyncs = []
+        for future in futures:
+            asy = FutureAsync(future)
+            asy.start()
+            asyncs.append(asy)
+        return BindingAsync(asyncs, **kwargs)
+
+    @classmethod
+    def from_future(cls, future, **kwargs):
+        return FutureAsync(future, **kwargs)
+
+    @classmethod
+    def from_coroutine(cls, coro, loop=None, **kwargs):
+        """
+        Creates an Async which runs the coroutine.
+
+        loop: event loop running in another thread to run the coroutine on.
+              If omitted, the coroutine runs on a new event loop in the
+              thread of the Async.
+        """
+        if loop is None:
+            return cls(target=asyncio.run, args=(coro,), **kwargs)
+        return FutureAsync(asyncio.run_coroutine_threadsafe(coro, loop), **kwargs)
+
+    @classmethod
+    def gather(cls, asyncs, **kwargs):
+        """
+        Results in the list of the results of asyncs, or fails with the
+        first error among them.
+        """
+        return BindingAsync(asyncs, **kwargs)
+
+    @classmethod
+    def first_completed(cls, asyncs, **kwargs):
+        """
+        Results in the first Async among asyncs which finishes.
+        """
+        return FirstCompletedAsync(asyncs, **kwargs)
+
+    @classmethod
+    def with_timeout(cls, asy, timeout, **kwargs):
+        """
+        Results in the result of asy, or fails with
+        concurrent.futures.TimeoutError if asy does not finish in timeout
+        seconds.
+        """
+        return TimeoutAsync(asy, timeout, **kwargs)
+
+    @staticmethod
+    def as_completed(asyncs, timeout=None):
+        """
+        Yields asyncs as they finish. Raises concurrent.futures.TimeoutError
+        if they do not all finish in timeout seconds.
+        """
+        asyncs = list(asyncs)
+        q = queue.Queue()
+        for asy in asyncs:
+            asy.add_done_callback(q.put)
 
-        return cls(target=target, **kwargs)
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        for i in range(len(asyncs)):
+            remaining = None
+            if timeout is not None:
+                remaining = max(0, deadline - time.monotonic())
+            try:
+                yield q.get(timeout=remaining)
+            except queue.Empty:
+                raise concurrent.futures.TimeoutError(
+                    "{} of {} asyncs did not finish".format(len(asyncs) - i, len(asyncs)))
 
     def __repr__(self):
         return "Async(process=\"{}\" id={} started={} finished={} error={})".format(self.process_name, id(self), self.started, self.finished, self.error)
 
-    def on_error(self, handler):
-        self.handlers_on_error.append(handler)
+    # loop: asyncio event loop on which the handler is scheduled
+    #       (thread-safely) instead of being called in the task thread.
+
+    def on_error(self, handler, loop=None):
+        self.handlers_on_error.append(_schedule_on_loop(handler, loop))
 
-    def on_success(self, handler):
-        self.handlers_on_success.append(handler)
+    def on_success(self, handler, loop=None):
+        self.handlers_on_success.append(_schedule_on_loop(handler, loop))
 
-    def on_done(self, handler):
-        self.handlers_on_done.append(handler)
+    def on_done(self, handler, loop=None):
+        self.handlers_on_done.append(_schedule_on_loop(handler, loop))
+
+    def add_done_callback(self, handler, loop=None):
+        """
+        Same as on_done(), except that handler is called immediately if the
+        done handlers have already been called.
+        """
+        handler = _schedule_on_loop(handler, loop)
+        with self.lock:
+            if not self.done_handlers_called:
+                self.handlers_on_done.append(handler)
+                return
+        handler(self)
+
+    def __await__(self):
+        """
+        Waits for the task in a coroutine without blocking the event loop.
+        The task is started if it has not been. Cancelling the awaiting
+        coroutine cancels the task.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.scheduled:
+            self.start()
+        self.add_done_callback(lambda asy: loop.call_soon_threadsafe(_set_future_outcome, future, asy))
+
+        def on_future_done(f):
+            if f.cancelled():
+                self.cancel()
+        future.add_done_callback(on_future_done)
+
+        return future.__await__()
 
     def call_handlers(self, handlers, args=()):
+        if len(handlers) == 0:
+            return
+        metrics = _metrics
+        if metrics is not None:
+            begin_time = time.perf_counter()
         for handler in handlers:
-            handler(self, *args)
+            # A failing handler must not keep the task from completing.
+            try:
+                handler(self, *args)
+            except Exception:
+                logger.exception("Handler failed: {}".format(self))
+        if metrics is not None:
+            metrics.handlers_called(self, begin_time, time.perf_counter())
 
-    def run(self):
-        logger.debug("Thread starts: async={} thread={}".format(id(self), threading.current_thread()))
+    def begin(self):
         assert not self.started
         args = self.args
         self.process_name = multiprocessing.current_process().name
         if args is None:
             args = ()
         self.started = True
+        metrics = _metrics
+        if metrics is not None:
+            self.begin_time = time.perf_counter()
+            metrics.task_started(self)
+        return args
+
+    def complete(self, res, error):
+        """
+        Sets the outcome and calls the handlers. Returns False if the Async
+        has already been completed.
+        """
+        with self.lock:
+            if self.completing:
+                return False
+            self.completing = True
+
         try:
-            res = self.target(*args)
-        except Exception as e:
-            self.error = True
-            res = None
-            self.call_handlers(self.handlers_on_error, (e,))
+            if error is not None:
+                self.error = True
+                self.exception = error
+                res = None
+                self.call_handlers(self.handlers_on_error, (error,))
+
+                if self.print_on_error:
+                    traceback.print_exception(type(error), error, error.__traceback__)
 
-            if self.print_on_error:
-                import traceback
-                traceback.print_exc()
+            self.result = res
+            self.finished = True
 
-        self.result = res
-        self.finished = True
+            metrics = _metrics
+            if metrics is not None:
+                metrics.task_completed(self, time.perf_counter())
 
-        if not self.error:
-            self.call_handlers(self.handlers_on_success)
+            if not self.error:
+                self.call_handlers(self.handlers_on_success)
+        finally:
+            # Waiters (join(), gather(), schedulers) depend on the done
+            # handlers and done_event whatever happened above.
+            with self.lock:
+                self.done_handlers_called = True
+                handlers = list(self.handlers_on_done)
+            try:
+                self.call_handlers(handlers)
+            finally:
+                self.done_event.set()
+        return True
 
-        self.call_handlers(self.handlers_on_done)
+    def run(self):
+        logger.debug("Thread starts: async={} thread={}".format(id(self), threading.current_thread()))
+        args = self.begin()
+        if self.cancel_token.cancelled:
+            self.complete(None, concurrent.futures.CancelledError())
+            return
+        kwargs = {}
+        if self.pass_cancel_token:
+            kwargs['cancel_token'] = self.cancel_token
+        try:
+            res = self.target(*args, **kwargs)
+        except Exception as e:
+            self.complete(None, e)
+        else:
+            self.complete(res, None)
         logger.debug("Thread exitting: async={} thread={}".format(id(self), threading.current_thread()))
 
-    def start(self):
-        self.run_thread()
+    def start(self, executor=None):
+        if self.completing:
+            # Cancelled before being started.
+            return
+        if executor is None:
+            executor = self.executor
+        if executor is None and not self.use_process:
+            self.run_thread()
+        else:
+            self.run_executor(executor)
 
     def run_thread(self):
         assert not self.started
@@ -98,20 +687,397 @@ class Async(object):
         thread.daemon = True
 
         self.thread = thread
+        self.scheduled = True
+        self.schedule_time = time.perf_counter()
         thread.start()
 
-    def join(self):
-        logger.info("Joining: {}".format(self))
-        assert self.thread is not None
-        self.thread.join()
-        logger.info("Join successfull: {}".format(self))
+    def run_executor(self, executor=None, block=True, timeout=None):
+        """
+        Schedules the task on executor, or on the default executor if
+        omitted. See AsyncExecutor.submit().
+        """
+        if executor is None:
+            executor = get_default_executor()
+        executor.submit(self, block, timeout)
 
-    def get(self):
-        self.join()
+    def join(self, timeout=None):
+        """
+        Waits until the task finishes. Returns False on timeout.
+        """
+        assert self.scheduled or self.completing, "Async is not started: {}".format(self)
+        logger.debug("Joining: {}".format(self))
+        if not self.done_event.wait(timeout):
+            return False
+        logger.debug("Join successfull: {}".format(self))
+        return True
+
+    def get(self, timeout=None):
+        """
+        Returns the result of the task, or raises its exception.
+        Raises concurrent.futures.TimeoutError on timeout.
+        """
+        if not self.join(timeout):
+            raise concurrent.futures.TimeoutError("Async did not finish in {} seconds: {}".format(timeout, self))
+        if self.error:
+            raise self.exception
         return self.result
 
+    def cancel(self):
+        """
+        Requests cancellation. A task which has not started yet will not
+        run, and fails with concurrent.futures.CancelledError. A running
+        task is only notified through its cancel token; its outcome is
+        whatever the target returns or raises (e.g. through
+        CancellationToken.raise_if_cancelled()).
+        """
+        self.cancel_token.cancel()
+        if not self.scheduled:
+            self.complete(None, concurrent.futures.CancelledError())
+        elif self.future is not None and self.future.cancel() and not self.use_process:
+            # Removed from the executor queue; run() will not be called.
+            # (Process tasks are completed by the done callback of the future.)
+            self.complete(None, concurrent.futures.CancelledError())
+
+
+class CallbackAsync(Async, metaclass=abc.ABCMeta):
+    """
+    Base class of Asyncs which run no target, but are completed by
+    callbacks registered in attach().
+    """
+
+    def start(self, executor=None):
+        if self.completing:
+            return
+        self.schedule_time = time.perf_counter()
+        self.begin()
+        self.scheduled = True
+        self.attach()
+
+    @abc.abstractmethod
+    def attach(self):
+        pass
+
+    def cancel(self):
+        self.cancel_token.cancel()
+        self.complete(None, concurrent.futures.CancelledError())
+
+
+class FutureAsync(CallbackAsync):
+    """
+    Async which completes with a concurrent.futures.Future.
+    """
+
+    def __init__(self, future, **kwargs):
+        super(FutureAsync, self).__init__(**kwargs)
+        self.source = future
+
+    def attach(self):
+        self.source.add_done_callback(self.on_source_done)
+
+    def cancel(self):
+        self.source.cancel()
+        super(FutureAsync, self).cancel()
+
+    def on_source_done(self, future):
+        if future.cancelled():
+            self.complete(None, concurrent.futures.CancelledError())
+            return
+        error = future.exception()
+        if error is not None:
+            self.complete(None, error)
+        else:
+            self.complete(future.result(), None)
+
+
+class BindingAsync(CallbackAsync):
+    """
+    Async which completes with the list of the results of asyncs once all of
+    them have finished, or with the first error among them.
+    """
 
-class BindingAsync(Async):
     def __init__(self, asyncs, **kwargs):
         super(BindingAsync, self).__init__(**kwargs)
-        pass
+        self.asyncs = list(asyncs)
+        self.remaining = len(self.asyncs)
+
+    def attach(self):
+        if len(self.asyncs) == 0:
+            self.complete([], None)
+            return
+        for asy in self.asyncs:
+            asy.add_done_callback(self.on_async_done)
+
+    def on_async_done(self, asy):
+        if asy.error:
+            self.complete(None, asy.exception)
+            return
+        with self.lock:
+            self.remaining -= 1
+            remaining = self.remaining
+        if remaining == 0:
+            self.complete([a.result for a in self.asyncs], None)
+
+
+class FirstCompletedAsync(CallbackAsync):
+    """
+    Async which completes with the first Async among asyncs which finishes.
+    """
+
+    def __init__(self, asyncs, **kwargs):
+        super(FirstCompletedAsync, self).__init__(**kwargs)
+        self.asyncs = list(asyncs)
+        assert len(self.asyncs) > 0
+
+    def attach(self):
+        for asy in self.asyncs:
+            asy.add_done_callback(lambda asy: self.complete(asy, None))
+
+
+class TimeoutAsync(CallbackAsync):
+    """
+    Async which completes with the outcome of asy, or with
+    concurrent.futures.TimeoutError if asy does not finish in timeout
+    seconds.
+    """
+
+    def __init__(self, asy, timeout, **kwargs):
+        super(TimeoutAsync, self).__init__(**kwargs)
+        self.asy = asy
+        self.timeout = timeout
+        self.timer = None
+
+    def attach(self):
+        self.timer = _timer.schedule(self.timeout, self.on_timeout)
+        self.asy.add_done_callback(self.on_async_done)
+
+    def on_timeout(self):
+        self.complete(None, concurrent.futures.TimeoutError(
+            "Async did not finish in {} seconds: {}".format(self.timeout, self.asy)))
+
+    def on_async_done(self, asy):
+        _timer.cancel(self.timer)
+        self.complete(asy.result, asy.exception)
+
+
+class ScheduledTask(object):
+    def __init__(self, name, target, args, deps, priority):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.deps = deps
+        self.priority = priority
+        self.dependents = []
+        self.remaining = len(deps)
+        self.asy = None
+        self.ready_time = None
+        self.start_time = None
+        self.end_time = None
+
+    def get_trace(self):
+        record = {
+            'name': self.name,
+            'priority': self.priority,
+            'ready_time': self.ready_time,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'queue_time': None,
+            'run_time': None,
+            'error': self.asy.exception,
+        }
+        if self.ready_time is not None and self.start_time is not None:
+            record['queue_time'] = self.start_time - self.ready_time
+        if self.start_time is not None and self.end_time is not None:
+            record['run_time'] = self.end_time - self.start_time
+        return record
+
+
+class TaskScheduler(object):
+    """
+    Runs a graph of tasks with dependencies and priorities on a bounded pool.
+
+    A task is dispatched as soon as all its dependencies have finished, and
+    ready tasks with higher priority are dispatched first. The target of a
+    task is called with its args followed by the results of its
+    dependencies (the objects themselves, not copies). If a task fails, the
+    tasks depending on it are cancelled.
+
+        scheduler = TaskScheduler(max_workers=4)
+        scheduler.add('probe', probe, args=(path,))
+        scheduler.add('video', encode_video, deps=['probe'], priority=1)
+        scheduler.add('audio', encode_audio, deps=['probe'])
+        scheduler.add('mux', mux, deps=['video', 'audio'])
+        results = scheduler.run()
+    """
+
+    def __init__(self, max_workers=None, executor=None):
+        """
+        executor: AsyncExecutor to run the tasks on. If omitted, one with
+                  max_workers threads is created and shut down when all
+                  tasks have finished.
+        """
+        self.own_executor = executor is None
+        if executor is None:
+            executor = AsyncExecutor(max_workers)
+        if max_workers is None:
+            max_workers = executor.max_workers
+        self.executor = executor
+        self.max_workers = max_workers
+        self.tasks = {}
+        self.ready = []
+        self.counter = itertools.count()
+        self.running = 0
+        self.lock = threading.RLock()
+        self.trace_hooks = []
+        self.trace = []
+        self.error = None
+        self.asy = None
+
+    def add(self, name, target, deps=(), priority=0, args=()):
+        """
+        Returns the Async of the task.
+        """
+        assert self.asy is None, "Tasks cannot be added after start()."
+        if name in self.tasks:
+            raise RuntimeError("Duplicate task: {}".format(name))
+        task = ScheduledTask(name, target, tuple(args), tuple(deps), priority)
+        task.asy = Async(target=self.call_task, args=(task,), name=name)
+        self.tasks[name] = task
+        return task.asy
+
+    def on_trace(self, hook):
+        """
+        hook(record) is called when a task finishes, where record is a dict
+        with the name, priority, error, and the times (time.monotonic())
+        when the task became ready, started and ended, and the queue and run
+        durations derived from them.
+        """
+        self.trace_hooks.append(hook)
+
+    def check(self):
+        for task in self.tasks.values():
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise RuntimeError("Unknown dependency of {}: {}".format(task.name, dep))
+
+        # Detect cycles by removing tasks without remaining dependencies.
+        remaining = {name: len(task.deps) for name, task in self.tasks.items()}
+        dependents = {name: [] for name in self.tasks}
+        for task in self.tasks.values():
+            for dep in task.deps:
+                dependents[dep].append(task.name)
+        stack = [name for name, n in remaining.items() if n == 0]
+        visited = 0
+        while len(stack) > 0:
+            name = stack.pop()
+            visited += 1
+            for dependent in dependents[name]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    stack.append(dependent)
+        if visited != len(self.tasks):
+            cycle = sorted(name for name, n in remaining.items() if n > 0)
+            raise RuntimeError("Dependency cycle among tasks: {}".format(cycle))
+
+    def start(self):
+        """
+        Starts dispatching tasks. Returns an Async which results in the
+        dict of the results of all the tasks once all of them have
+        finished, or fails with the first error.
+        """
+        assert self.asy is None
+        self.check()
+        for task in self.tasks.values():
+            for dep in task.deps:
+                self.tasks[dep].dependents.append(task)
+
+        self.future = concurrent.futures.Future()
+        self.asy = Async.from_future(self.future)
+        self.asy.start()
+        self.unfinished = len(self.tasks)
+        if self.unfinished == 0:
+            self.finish()
+            return self.asy
+
+        with self.lock:
+            for task in self.tasks.values():
+                task.asy.add_done_callback(lambda asy, task=task: self.on_task_done(task))
+                if task.remaining == 0:
+                    self.push_ready(task)
+            self.dispatch()
+        return self.asy
+
+    def run(self, timeout=None):
+        """
+        Runs all the tasks and returns the dict of their results.
+        """
+        return self.start().get(timeout)
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.asy.cancel()
+
+    def call_task(self, task):
+        task.start_time = time.monotonic()
+        args = task.args + tuple(self.tasks[dep].asy.result for dep in task.deps)
+        return task.target(*args)
+
+    def push_ready(self, task):
+        task.ready_time = time.monotonic()
+        heapq.heappush(self.ready, (-task.priority, next(self.counter), task))
+
+    def dispatch(self):
+        while self.running < self.max_workers and len(self.ready) > 0:
+            _, _, task = heapq.heappop(self.ready)
+            if task.asy.completing:
+                # Cancelled while waiting.
+                continue
+            self.running += 1
+            task.asy.run_executor(self.executor)
+
+    def on_task_done(self, task):
+        task.end_time = time.monotonic()
+        try:
+            with self.lock:
+                if task.asy.scheduled:
+                    self.running -= 1
+
+                if task.asy.error:
+                    if self.error is None and not isinstance(task.asy.exception, concurrent.futures.CancelledError):
+                        self.error = task.asy.exception
+                    for dependent in task.dependents:
+                        dependent.asy.cancel()
+                else:
+                    for dependent in task.dependents:
+                        dependent.remaining -= 1
+                        if dependent.remaining == 0:
+                            self.push_ready(dependent)
+                self.dispatch()
+
+                record = task.get_trace()
+                self.trace.append(record)
+                for hook in self.trace_hooks:
+                    try:
+                        hook(record)
+                    except Exception:
+                        logger.exception("Trace hook failed: {}".format(task.name))
+        finally:
+            # The scheduler must finish whatever failed above, or run()
+            # would wait forever.
+            with self.lock:
+                self.unfinished -= 1
+                finished = self.unfinished == 0
+            if finished:
+                self.finish()
+
+    def finish(self):
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
+        if self.error is None:
+            for task in self.tasks.values():
+                if task.asy.error:
+                    self.error = task.asy.exception
+                    break
+        if self.error is not None:
+            self.future.set_exception(self.error)
+        else:
+            self.future.set_result({name: task.asy.result for name, task in self.tasks.items()})
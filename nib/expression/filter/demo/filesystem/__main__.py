@@ -1,19 +1,56 @@
-import sys
 import re
+import argparse
 
+from nib import hashing
 from nib.expression.filter import parser, environment
 from .generators import get_generator_classes
 
 
 class EvaluationEnvironment(environment.EvaluationEnvironment):
+    identities = ('path', 'inode')
+
+    def __init__(self, identity='path', digest_cache=None):
+        """
+        identity: 'path' compares items by their paths.
+                  'inode' compares items by (st_dev, st_ino), so that files
+                  reachable through several hardlinks or symlinks are
+                  yielded only once.
+        digest_cache: nib.hashing.DigestCache used by the hash filter.
+        """
+        if identity not in self.identities:
+            raise RuntimeError("Invalid identity: {}".format(identity))
+        self.identity = identity
+        self.digest_cache = digest_cache
+
     def get_generators(self):
-        return [cls() for cls in get_generator_classes()]
+        return {cls.key: cls() for cls in get_generator_classes()}
+
+    def get_set_ops(self):
+        if self.identity == 'inode':
+            return environment.SetOperations(key=lambda item: item.get_identity())
+        return environment.SetOperations()
+
+    def get_digest(self, item, algorithm):
+        if self.digest_cache is None:
+            return hashing.hash_file(item.get_path(), algorithm)
+        return self.digest_cache.digest(item.get_path(), algorithm, st=item.get_stat())
 
 
 def run_demo():
-    args = sys.argv[1:]
-    if len(args) > 0:
-        queries = args
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--identity', choices=EvaluationEnvironment.identities, default='path')
+    argparser.add_argument('--digest-cache', metavar='PATH')
+    argparser.add_argument('--duplicates', action='store_true',
+                           help="Show groups of files with identical content among the results.")
+    argparser.add_argument('queries', nargs='*')
+    args = argparser.parse_args()
+
+    digest_cache = None
+    if args.digest_cache is not None:
+        digest_cache = hashing.DigestCache(args.digest_cache)
+
+    if len(args.queries) > 0:
+        queries = args.queries
     else:
         # Some toy examples
         queries = [
@@ -41,13 +78,24 @@ def run_demo():
         print("=" * (len(msg)+1))
 
         expr_tree = parser.QueryParser(query).getTree()
-        env = EvaluationEnvironment()
+        env = EvaluationEnvironment(identity=args.identity, digest_cache=digest_cache)
 
-        for item in expr_tree.eval(env):
-            print(item.get_path())
+        items = env.unique(expr_tree.eval(env))
+        if args.duplicates:
+            paths = (file_item.get_path() for item in items for file_item in item.recurse_file_items())
+            for group in hashing.find_duplicates(paths, cache=digest_cache):
+                for path in group:
+                    print(path)
+                print()
+        else:
+            for item in items:
+                print(item.get_path())
 
         print()
 
+    if digest_cache is not None:
+        digest_cache.close()
+
 
 if __name__ == '__main__':
     run_demo()
@@ -3,7 +3,7 @@ import re
 
 from nib.expression.filter.generator import (Generator, Filter, GeneratorSpec)
 
-from .objects import (FileItem, DirItem)
+from .objects import (FileItem, DirItem, stat_file)
 
 
 def get_generator_classes():
@@ -14,6 +14,7 @@ def get_generator_classes():
         SymlinkFilter,
         RecurseFilter,
         RealpathFilter,
+        HashFilter,
     ]
 
 
@@ -98,7 +99,31 @@ class RealpathFilter(Filter):
             raise RuntimeError("RealpathFilter does not support negative filtering.")
         for item in input:
             realpath = os.path.realpath(item.get_path())
-            if os.path.isfile(realpath):
-                yield FileItem(realpath)
+            st = stat_file(realpath)
+            if st is not None:
+                yield FileItem(realpath, st)
             else:
                 yield DirItem(realpath)
+
+
+@GeneratorSpec('hash')
+class HashFilter(Filter):
+    """
+    hash:[<algorithm>:]<hex digest prefix>
+
+    The algorithm defaults to md5.
+    """
+    require_env = True
+
+    def filter_impl(self, input, qt, opts, positive, env):
+        if ':' in qt:
+            algorithm, digest = qt.split(':', 1)
+        else:
+            algorithm, digest = 'md5', qt
+        digest = digest.lower()
+
+        for item in input:
+            for file_item in item.recurse_file_items():
+                match = env.get_digest(file_item, algorithm).startswith(digest)
+                if positive == match:
+                    yield file_item
@@ -1,12 +1,29 @@
 import os
 import abc
+import stat
 
 from nib.expression.filter import environment
 
 
+def stat_file(path):
+    """
+    Returns the stat of the regular file at path (symlinks are followed), or
+    None if it is not a regular file.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st
+
+
 class Item(object):
     __metaclass__ = abc.ABCMeta
 
+    _stat = None
+
     def __init__(self):
         pass
 
@@ -24,11 +41,27 @@ class Item(object):
     def get_path(self):
         pass
 
+    def get_stat(self):
+        # Symlinks are followed, so that links share the stat of their target.
+        if self._stat is None:
+            self._stat = os.stat(self.get_path())
+        return self._stat
+
+    def get_identity(self):
+        # Items which cannot be stat'ed (e.g. nonexistent paths) are
+        # identified by their path instead.
+        try:
+            st = self.get_stat()
+        except OSError:
+            return ('path', self.get_path())
+        return (st.st_dev, st.st_ino)
+
 
 class FileItem(Item):
-    def __init__(self, path):
+    def __init__(self, path, st=None):
         self._path = path
-        assert os.path.isfile(self._path)
+        self._stat = st
+        assert st is not None or os.path.isfile(self._path)
 
     def get_path(self):
         return self._path
@@ -37,7 +70,7 @@ class FileItem(Item):
         yield self
 
     def get_size(self):
-        return os.path.getsize(self._path)
+        return self.get_stat().st_size
 
 
 class DirItem(Item):
@@ -55,13 +88,15 @@ class DirItem(Item):
                     yield DirItem(dir_path)
             for filename in filenames:
                 file_path = os.path.join(dirpath, filename)
-                if os.path.isfile(file_path):
-                    yield FileItem(file_path)
+                st = stat_file(file_path)
+                if st is not None:
+                    yield FileItem(file_path, st)
             break
 
     def recurse_file_items(self):
         for dirpath, dirnames, filenames in os.walk(self._path):
             for filename in filenames:
                 file_path = os.path.join(dirpath, filename)
-                if os.path.isfile(file_path):
-                    yield FileItem(file_path)
+                st = stat_file(file_path)
+                if st is not None:
+                    yield FileItem(file_path, st)
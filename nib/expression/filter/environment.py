@@ -1,5 +1,5 @@
 import abc
-import collections
+import collections.abc
 
 
 class EvaluationEnvironment(object):
@@ -32,6 +32,9 @@ class EvaluationEnvironment(object):
         gen2 = o2.eval(self, source, positive2)
         return self.get_set_ops().union(gen1, gen2)
 
+    def unique(self, gen):
+        return self.get_set_ops().unique(gen)
+
     def intersection(self, source, o1, o2, positive1, positive2):
         gen1 = o1.eval(self, source, positive1)
         gen2 = o2.eval(self, gen1, positive2)
@@ -39,17 +42,42 @@ class EvaluationEnvironment(object):
 
 
 class SetOperations(object):
+    def __init__(self, key=None):
+        """
+        key: function which maps an item to its identity. Items are compared
+             as-is if omitted.
+        """
+        self.key = key
+
+    def get_key(self, item):
+        if self.key is None:
+            return item
+        return self.key(item)
+
     def union(self, gen1, gen2):
         ret = self.union_impl(gen1, gen2)
-        assert isinstance(ret, collections.Iterable)
+        assert isinstance(ret, collections.abc.Iterable)
         return ret
 
     def union_impl(self, gen1, gen2):
         set1 = set()
         for item1 in gen1:
+            key1 = self.get_key(item1)
+            if key1 in set1:
+                continue
             yield item1
-            set1.add(item1)
+            set1.add(key1)
 
         for item2 in gen2:
-            if item2 not in set1:
+            key2 = self.get_key(item2)
+            if key2 not in set1:
                 yield item2
+                set1.add(key2)
+
+    def unique(self, gen):
+        seen = set()
+        for item in gen:
+            key = self.get_key(item)
+            if key not in seen:
+                yield item
+                seen.add(key)
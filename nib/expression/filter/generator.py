@@ -1,5 +1,5 @@
 import abc
-import collections
+import collections.abc
 
 
 def GeneratorSpec(key, **kwargs):
@@ -17,11 +17,11 @@ class AbstractGenerator(object):
         assert isinstance(opts, dict), type(opts)
         assert isinstance(positive, bool), type(positive)
         if input is not None:
-            assert isinstance(input, collections.Iterable)
+            assert isinstance(input, collections.abc.Iterable)
 
         ret = self._eval(env, input, qt, opts, positive)
 
-        assert ret is None or isinstance(ret, collections.Iterable)
+        assert ret is None or isinstance(ret, collections.abc.Iterable)
         return ret
 
     def _eval(self, env, input, qt, opts, positive):
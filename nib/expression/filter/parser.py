@@ -2,7 +2,7 @@ import sys
 import abc
 import re
 import logging
-import collections
+import collections.abc
 
 from .environment import EvaluationEnvironment
 
@@ -253,7 +253,7 @@ class BinaryOperator(Operator):
         logger.debug("Evaluating op: {} o1={} o2={}".format(self.__class__.__name__, o1, o2))
         assert isinstance(env, EvaluationEnvironment)
         ret = self.eval_impl(env, source, positive, o1, o2)
-        assert isinstance(ret, collections.Iterable)
+        assert isinstance(ret, collections.abc.Iterable)
         return ret
 
     @abc.abstractmethod
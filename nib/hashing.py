@@ -0,0 +1,443 @@
+import os
+import stat
+import mmap
+import sqlite3
+import hashlib
+import threading
+import concurrent.futures
+
+from nib import encodePath
+
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+PARTIAL_HASH_SIZE = 64 * 1024
+
+
+def default_max_workers():
+    # Same as the default of concurrent.futures.ThreadPoolExecutor.
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+def update_from_file(m, f, buffer_size=DEFAULT_BUFFER_SIZE):
+    """
+    Feeds the rest of the unbuffered binary file f into the hash object m,
+    reusing a single buffer.
+    """
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        m.update(view[:n])
+
+
+def iter_buffers(data):
+    """
+    Yields memoryviews of data, which is a buffer-protocol object (bytes,
+    bytearray, memoryview, mmap, array, ...) or an iterable of them. No data
+    is copied.
+    """
+    try:
+        view = memoryview(data)
+    except TypeError:
+        for chunk in data:
+            yield memoryview(chunk)
+    else:
+        yield view
+
+
+def update_from_buffers(m, data):
+    """
+    Feeds data (see iter_buffers()) into the hash object m.
+    """
+    for view in iter_buffers(data):
+        m.update(view)
+
+
+def hash_file(path, algorithm='md5', buffer_size=DEFAULT_BUFFER_SIZE, use_mmap=False):
+    """
+    Returns the hex digest of the file content.
+
+    algorithm: any name accepted by hashlib.new(), e.g. 'md5', 'sha256' or
+               'blake2b'.
+    use_mmap:  hash a memory map of the file in one call instead of reading
+               it into a buffer.
+    """
+    m = hashlib.new(algorithm)
+    with open(encodePath(path), 'rb', buffering=0) as f:
+        if use_mmap and os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                m.update(mm)
+        else:
+            update_from_file(m, f, buffer_size)
+    return m.hexdigest()
+
+
+def hash_file_ends(path, algorithm='md5', size=PARTIAL_HASH_SIZE):
+    """
+    Returns the hex digest of the first and the last size bytes of the file.
+    Files not larger than 2 * size are hashed entirely.
+    """
+    m = hashlib.new(algorithm)
+    with open(encodePath(path), 'rb', buffering=0) as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size <= 2 * size:
+            update_from_file(m, f, max(file_size, 1))
+        else:
+            m.update(f.read(size))
+            f.seek(-size, os.SEEK_END)
+            m.update(f.read(size))
+    return m.hexdigest()
+
+
+def _map_unordered(func, iterable, max_workers=None, max_pending=None):
+    """
+    Calls func on each item of iterable on a thread pool and yields
+    (item, result) in completion order.
+
+    At most max_pending calls are submitted at a time, so that iterable can
+    be an arbitrarily long stream.
+    """
+    if max_workers is None:
+        max_workers = default_max_workers()
+    if max_pending is None:
+        max_pending = max_workers * 4
+    assert max_pending >= 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        pending = {}
+        try:
+            for item in iterable:
+                pending[executor.submit(func, item)] = item
+                if len(pending) < max_pending:
+                    continue
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+
+            while len(pending) > 0:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def hash_files(paths, algorithm='md5', max_workers=None, max_pending=None, **kwargs):
+    """
+    Hashes files on a thread pool and yields (path, hex digest) as each
+    file finishes. hashlib releases the GIL while hashing large buffers, so
+    hashing scales with the number of workers.
+
+    The remaining keyword arguments are passed to hash_file().
+    """
+    def func(path):
+        return hash_file(path, algorithm, **kwargs)
+
+    return _map_unordered(func, paths, max_workers, max_pending)
+
+
+class Hasher(object):
+    """
+    Incremental hasher, which computes digests of one or more algorithms in
+    a single pass over the data.
+
+    update() is serialized by a lock, so a Hasher can be fed from several
+    threads (e.g. Async tasks), as long as they feed the chunks in order.
+
+        with Hasher('md5', 'sha256') as hasher:
+            for chunk in chunks:
+                hasher.update(chunk)
+        hasher.hexdigests()  # {'md5': ..., 'sha256': ...}
+    """
+
+    def __init__(self, *algorithms):
+        if len(algorithms) == 0:
+            algorithms = ('md5',)
+        self.algorithms = algorithms
+        self.hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Forbids further updates.
+        """
+        with self.lock:
+            self.closed = True
+
+    def update(self, data):
+        """
+        data: a buffer-protocol object or an iterable of them.
+        """
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Hasher is already closed.")
+            for view in iter_buffers(data):
+                for m in self.hashes:
+                    m.update(view)
+
+    def update_file(self, path, buffer_size=DEFAULT_BUFFER_SIZE):
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        with open(encodePath(path), 'rb', buffering=0) as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                self.update(view[:n])
+
+    def hexdigest(self, algorithm=None):
+        """
+        algorithm: may be omitted if the Hasher has only one algorithm.
+        """
+        if algorithm is None:
+            if len(self.hashes) != 1:
+                raise RuntimeError("Algorithm must be specified: {}".format(self.algorithms))
+            m = self.hashes[0]
+        else:
+            m = self.hashes[self.algorithms.index(algorithm)]
+        with self.lock:
+            return m.hexdigest()
+
+    def hexdigests(self):
+        with self.lock:
+            return {algorithm: m.hexdigest() for algorithm, m in zip(self.algorithms, self.hashes)}
+
+
+def _stat_regular_file(path):
+    try:
+        st = os.stat(encodePath(path))
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st
+
+
+def find_duplicates(paths, algorithm='md5', partial_size=PARTIAL_HASH_SIZE, min_size=1,
+                    max_workers=None, cache=None):
+    """
+    Finds files with identical content and yields each group of duplicates
+    as a sorted list of paths.
+
+    Files are compared in stages, each stage only looking at the files which
+    still collide after the previous one:
+      1. the file size,
+      2. the digest of the first and the last partial_size bytes,
+      3. the digest of the whole file (taken from cache, a DigestCache, if
+         given; files with a cached digest skip stage 2).
+    Paths which are hardlinks of the same file are hashed only once, and are
+    reported together with the duplicates of that file, but do not form a
+    group by themselves. Paths which are not regular files are ignored.
+
+    Groups confirmed by the partial digest (small files) are yielded first,
+    then the others are yielded as their full digests complete. Files which
+    are removed or become unreadable during the scan are dropped.
+    """
+
+    # Stage 1: group files by size, and paths by file identity.
+    by_size = {}
+    for path, st in _map_unordered(_stat_regular_file, paths, max_workers):
+        if st is None or st.st_size < min_size:
+            continue
+        files = by_size.setdefault(st.st_size, {})
+        identity = (st.st_dev, st.st_ino)
+        if identity in files:
+            files[identity][1].append(path)
+        else:
+            files[identity] = (st, [path])
+
+    # Each candidate is (st, [paths]) of a distinct file.
+    candidates = []
+    for files in by_size.values():
+        if len(files) >= 2:
+            candidates.extend(files.values())
+    del by_size
+
+    # Files whose full digest is cached skip stage 2, with the files of
+    # the same size which they have to be compared with, so that the
+    # contents of an unchanged tree are not read at all.
+    cached = {}
+    if cache is not None:
+        for st, paths in candidates:
+            if cache.lookup(st, algorithm) is not None:
+                cached.setdefault(st.st_size, [])
+        for candidate in candidates:
+            if candidate[0].st_size in cached:
+                cached[candidate[0].st_size].append(candidate)
+        candidates = [c for c in candidates if c[0].st_size not in cached]
+
+    def group_paths(group):
+        return sorted(path for st, paths in group for path in paths)
+
+    # Stage 2: partial digests.
+    def partial_digest(candidate):
+        st, paths = candidate
+        try:
+            return hash_file_ends(paths[0], algorithm, partial_size)
+        except OSError:
+            return None
+
+    groups = {}
+    for candidate, digest in _map_unordered(partial_digest, candidates, max_workers):
+        if digest is None:
+            continue
+        groups.setdefault((candidate[0].st_size, digest), []).append(candidate)
+    del candidates
+
+    full_candidates = []
+    for (size, digest), group in groups.items():
+        if len(group) < 2:
+            continue
+        if size <= 2 * partial_size:
+            # The partial digest covered the whole content.
+            yield group_paths(group)
+        else:
+            full_candidates.append(group)
+    del groups
+    full_candidates.extend(cached.values())
+    del cached
+
+    # Stage 3: full digests.
+    def full_digest(item):
+        i, (st, paths) = item
+        try:
+            if cache is not None:
+                return cache.digest(paths[0], algorithm, st=st)
+            return hash_file(paths[0], algorithm)
+        except OSError:
+            return None
+
+    remaining = [len(group) for group in full_candidates]
+    results = [{} for group in full_candidates]
+    items = ((i, candidate) for i, group in enumerate(full_candidates) for candidate in group)
+    for (i, candidate), digest in _map_unordered(full_digest, items, max_workers):
+        if digest is not None:
+            results[i].setdefault(digest, []).append(candidate)
+        remaining[i] -= 1
+        if remaining[i] > 0:
+            continue
+        for group in results[i].values():
+            if len(group) >= 2:
+                yield group_paths(group)
+        results[i] = full_candidates[i] = None
+
+
+class DigestCache(object):
+    """
+    Persistent cache of file digests stored in an SQLite database.
+
+    Digests are keyed by (st_dev, st_ino) and algorithm, and are valid as
+    long as the file size and mtime_ns are unchanged, so files are read
+    only if they have changed since they were last hashed.
+    """
+    conn = None
+
+    def __init__(self, path, commit_interval=1000):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            ' dev INTEGER NOT NULL,'
+            ' ino INTEGER NOT NULL,'
+            ' algorithm TEXT NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' digest TEXT NOT NULL,'
+            ' PRIMARY KEY (dev, ino, algorithm))')
+        self.conn.commit()
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def lookup(self, st, algorithm='md5'):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime_ns, digest FROM digests'
+                ' WHERE dev = ? AND ino = ? AND algorithm = ?',
+                (st.st_dev, st.st_ino, algorithm)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            return None
+        return row[2]
+
+    def store(self, st, algorithm, digest):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO digests'
+                ' (dev, ino, algorithm, size, mtime_ns, digest)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (st.st_dev, st.st_ino, algorithm, st.st_size, st.st_mtime_ns, digest))
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_interval:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def digest(self, path, algorithm='md5', st=None):
+        """
+        Returns the hex digest of the file, reading it only on a cache miss.
+
+        st: stat of the file if already known.
+        """
+        if st is None:
+            st = os.stat(encodePath(path))
+        digest = self.lookup(st, algorithm)
+        if digest is not None:
+            return digest
+
+        digest = hash_file(path, algorithm)
+
+        # Do not cache the digest if the file was modified while reading it.
+        st2 = os.stat(encodePath(path))
+        if (st2.st_dev, st2.st_ino, st2.st_size, st2.st_mtime_ns) == \
+           (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns):
+            self.store(st, algorithm, digest)
+        return digest
+
+    def md5(self, path, file=True):
+        # Same signature as nib.md5.
+        if not file:
+            m = hashlib.md5()
+            update_from_buffers(m, path)
+            return m.hexdigest()
+        return self.digest(path, 'md5')
+
+    def hash_files(self, paths, algorithm='md5', max_workers=None, max_pending=None):
+        """
+        Same as hash_files(), but served from the cache where possible.
+        """
+        def func(path):
+            return self.digest(path, algorithm)
+
+        return _map_unordered(func, paths, max_workers, max_pending)
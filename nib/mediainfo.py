@@ -1,18 +1,352 @@
 # -*- mode:python; indent-tabs-mode:nil; python-indent:4 -*-
+import os
+import json
+import asyncio
+import weakref
+import time
+import mmap
+import struct
+import sqlite3
 import subprocess
 import signal
+import tempfile
+import threading
+import itertools
+import concurrent.futures
 
 class MediaInfoException(Exception): pass
 class MediaFileNotSupportedError(MediaInfoException): pass
 class MediaInfoInvalidResultError(MediaInfoException): pass
+class ContainerNotSupportedError(MediaInfoException): pass
+class MediaInfoTimeoutError(MediaInfoException): pass
+
+# Prefix of the marker lines which delimit the results in batch queries.
+MARKER = '@@nib@@'
 
 def subprocessPreexec():
     #signal.signal(signal.SIGINT, signal.SIG_IGN)
     pass
 
+def buildInformTemplate(entries):
+    """
+    Builds an --Inform template file content which queries all the entries
+    at once. entries is a list of (section, inform string) pairs.
+
+    The output of each section starts with a MARKER line with the section
+    name, and each entry with a MARKER line with its index.
+    """
+    sections = { }
+    for i, (section, inform) in enumerate(entries):
+        sections.setdefault(section, MARKER + section + '\\n')
+        sections[section] += '%s%d\\n%s\\n' % (MARKER, i, inform)
+    return ''.join('%s;%s\n' % (section, body) for section, body in sections.items())
+
+def parseInformOutput(data, entries):
+    """
+    Parses the output of a template built by buildInformTemplate(), and
+    returns the list of the values of the entries. Only the first stream of
+    each section is used.
+    """
+    values = [''] * len(entries)
+    seen = set()
+    accept = False
+    index = None
+    for line in data.decode('utf-8').split('\n'):
+        if line.startswith(MARKER):
+            name = line[len(MARKER):]
+            if name.isdigit():
+                index = int(name) if accept else None
+            else:
+                accept = name not in seen
+                seen.add(name)
+                index = None
+            continue
+        if index is not None:
+            values[index] = line
+            index = None
+    return values
+
+def splitInformOutputByFile(data):
+    """
+    Splits the output of a multi-file query into the outputs of each file,
+    each starting with the General section marker.
+    """
+    generalMarker = (MARKER + 'General\n').encode('utf-8')
+    chunks = data.split(b'\n' + generalMarker)
+    if chunks[0].startswith(generalMarker):
+        chunks[0] = chunks[0][len(generalMarker):]
+    elif len(chunks) > 0:
+        # Output before the first file
+        chunks.pop(0)
+    return [generalMarker + chunk for chunk in chunks]
+
+def runInformTemplate(entries, mediaFiles):
+    """
+    Runs mediainfo with a template built by buildInformTemplate(), and
+    returns its output.
+    """
+    fd, templatePath = tempfile.mkstemp(prefix='nib-mediainfo-', suffix='.txt')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(buildInformTemplate(entries))
+
+        cmd = ['mediainfo', '--Inform=file://%s' % templatePath] + list(mediaFiles)
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=False, preexec_fn = subprocessPreexec) as popen:
+            data = popen.communicate()[0]
+
+            if popen.returncode != 0:
+                raise MediaFileNotSupportedError('mediainfo failed with code %d.' % popen.returncode)
+    finally:
+        os.remove(templatePath)
+    return data
+
+# Maximum number of mediainfo processes run at a time by the asyncio API,
+# per event loop.
+asyncConcurrency = 16
+asyncSemaphores = weakref.WeakKeyDictionary()
+
+def setAsyncConcurrency(limit):
+    """
+    Sets the maximum number of mediainfo processes run at a time by
+    aquery_sections(). Applies to the event loops which have not used it yet.
+    """
+    global asyncConcurrency
+    asyncConcurrency = limit
+    asyncSemaphores.clear()
+
+def getAsyncSemaphore():
+    loop = asyncio.get_running_loop()
+    semaphore = asyncSemaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(asyncConcurrency)
+        asyncSemaphores[loop] = semaphore
+    return semaphore
+
+async def arunInformTemplate(entries, mediaFiles, timeout=None):
+    """
+    asyncio version of runInformTemplate(). mediainfo is killed and
+    MediaInfoTimeoutError is raised if it does not finish within timeout
+    seconds.
+    """
+    fd, templatePath = tempfile.mkstemp(prefix='nib-mediainfo-', suffix='.txt')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(buildInformTemplate(entries))
+
+        cmd = ['mediainfo', '--Inform=file://%s' % templatePath] + list(mediaFiles)
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE)
+        try:
+            data = (await asyncio.wait_for(proc.communicate(), timeout))[0]
+        except asyncio.TimeoutError:
+            raise MediaInfoTimeoutError('mediainfo timed out after %s seconds.' % timeout)
+        finally:
+            # Also reached on cancellation.
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+        if proc.returncode != 0:
+            raise MediaFileNotSupportedError('mediainfo failed with code %d.' % proc.returncode)
+    finally:
+        os.remove(templatePath)
+    return data
+
+def parseFullOutput(stream, fields=None, sections=False):
+    """
+    Parses the lines of mediainfo --Full output from stream, and yields
+    (section, tag, value). With sections, (section, None, None) is also
+    yielded at the start of each section of the result.
+
+    fields: dict of section -> list of tags to yield. Only the requested
+            tags are decoded, and parsing stops once all the requested
+            sections have been read.
+    """
+    wanted = None
+    remaining = None
+    if fields is not None:
+        wanted = {section.encode('utf-8'): set(tag.encode('utf-8') for tag in tags)
+                  for section, tags in fields.items()}
+        remaining = set(wanted)
+        if len(remaining) == 0:
+            return
+
+    section = None
+    sectionTags = None
+    for line in stream:
+        line = line.rstrip()
+        if len(line) == 0: continue
+        colon = line.find(b':')
+        if colon < 0:
+            if remaining is not None:
+                remaining.discard(section)
+                if len(remaining) == 0:
+                    return
+            section = line
+            sectionName = section.decode('utf-8')
+            if wanted is None:
+                sectionTags = None
+            else:
+                sectionTags = wanted.get(section)
+                if sectionTags is None:
+                    continue
+            if sections:
+                yield (sectionName, None, None)
+            continue
+        if section is None: raise MediaInfoInvalidResultError()
+        tag = line[:colon].rstrip()
+        if wanted is not None and (sectionTags is None or tag not in sectionTags):
+            continue
+        yield (sectionName, tag.decode('utf-8'), line[colon+1:].lstrip().decode('utf-8'))
+
+def specToEntries(spec):
+    return [(section, '%' + tag + '%') for section, tags in spec.items() for tag in tags]
+
+def entriesToSpecResult(spec, values):
+    d = { }
+    i = 0
+    for section, tags in spec.items():
+        d[section] = { }
+        for tag in tags:
+            d[section][tag] = values[i]
+            i += 1
+    return d
+
+class MediaInfoCache:
+    """
+    Persistent cache of MediaInfo results stored in an SQLite database.
+
+    Results are keyed by the path and the query, and are valid as long as
+    (st_dev, st_ino, st_size, st_mtime_ns) of the file are unchanged; stale
+    entries are dropped when looked up. At most maxEntries results are kept,
+    evicting the least recently used ones.
+    """
+    conn = None
+
+    def __init__(self, path, maxEntries=100000, commitInterval=100):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.commitInterval = commitInterval
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            ' path TEXT NOT NULL,'
+            ' query TEXT NOT NULL,'
+            ' dev INTEGER NOT NULL,'
+            ' ino INTEGER NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' result TEXT NOT NULL,'
+            ' last_access INTEGER NOT NULL,'
+            ' PRIMARY KEY (path, query))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)')
+        self.conn.commit()
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def getStats(self):
+        with self.lock:
+            d = dict(self.stats)
+            d['entries'] = self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        return d
+
+    def lookup(self, path, query, st):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT dev, ino, size, mtime_ns, result FROM results WHERE path = ? AND query = ?',
+                (path, query)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            if tuple(row[:4]) != (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns):
+                self.conn.execute('DELETE FROM results WHERE path = ? AND query = ?', (path, query))
+                self.stats['stale'] += 1
+                self.stats['misses'] += 1
+                self.commitLater()
+                return None
+            self.conn.execute(
+                'UPDATE results SET last_access = ? WHERE path = ? AND query = ?',
+                (time.time_ns(), path, query))
+            self.stats['hits'] += 1
+            self.commitLater()
+        return json.loads(row[4])
+
+    def store(self, path, query, st, result):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO results'
+                ' (path, query, dev, ino, size, mtime_ns, result, last_access)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, query, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                 json.dumps(result), time.time_ns()))
+            count = self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            if count > self.maxEntries:
+                self.conn.execute(
+                    'DELETE FROM results WHERE rowid IN'
+                    ' (SELECT rowid FROM results ORDER BY last_access LIMIT ?)',
+                    (count - self.maxEntries,))
+                self.stats['evictions'] += count - self.maxEntries
+            self.commitLater()
+
+    def commitLater(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commitInterval:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def fetch(self, path, query, func):
+        """
+        Returns the cached result of the query of the file, or calls func()
+        and caches its result.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        result = self.lookup(path, query, st)
+        if result is None:
+            # The stat taken before the query is stored, so that a file
+            # modified during the query is not considered up to date.
+            result = func()
+            self.store(path, query, st, result)
+        return result
+
+
+def queryKey(kind, spec):
+    return kind + ':' + json.dumps(spec, sort_keys=True)
+
 class MediaInfo:
-    def __init__(self, mediaFile):
+    def __init__(self, mediaFile, cache=None):
+        """
+        cache: MediaInfoCache to serve the results of querySingleSection(),
+               queryMultiSections() and queryFull() from.
+        """
         self.mediaFile = mediaFile
+        self.cache = cache
+
+    def cached(self, query, func):
+        if self.cache is None:
+            return func()
+        return self.cache.fetch(self.mediaFile, query, func)
 
     def close(self):
         pass
@@ -31,15 +365,156 @@ class MediaInfo:
         return val
 
     def query(self, tags):
+        # Tags of the form "Section;inform" are queried at once; others one
+        # by one.
         d = { }
+        entries = [ ]
         for tag in tags:
-            d[tag] = self.querySingle(tag)
+            if ';' in tag:
+                entries.append(tuple(tag.split(';', 1)))
+            else:
+                d[tag] = self.querySingle(tag)
+        if len(entries) > 0:
+            values = self.queryInform(entries)
+            for (section, inform), value in zip(entries, values):
+                d[section + ';' + inform] = value
         return d
 
+    def queryInform(self, entries):
+        """
+        Queries all the (section, inform string) entries in one mediainfo
+        invocation, and returns the list of their values.
+        """
+        data = runInformTemplate(entries, [self.mediaFile])
+        return parseInformOutput(data, entries)
+
+    @classmethod
+    def probe_many(cls, paths, spec, chunk_size=64, max_workers=None, cache=None):
+        """
+        Queries the sections and tags in spec (see queryMultiSections()) of
+        many files, passing chunk_size files to each mediainfo invocation
+        and running up to max_workers invocations at a time.
+
+        Yields (path, result) in completion order, where result is the dict
+        of queryMultiSections(), or a MediaInfoException if the file could
+        not be probed. If an invocation fails, the files of its chunk are
+        probed one by one, so that a bad file does not fail the others.
+
+        cache: MediaInfoCache. Cached results are yielded without running
+               mediainfo.
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        paths = iter(paths)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            pending = set()
+            try:
+                while True:
+                    while len(pending) < max_workers * 2:
+                        chunk = list(itertools.islice(paths, chunk_size))
+                        if len(chunk) == 0:
+                            break
+                        if cache is not None:
+                            misses = [ ]
+                            for path in chunk:
+                                result = cls.lookupCached(path, spec, cache)
+                                if result is None:
+                                    misses.append(path)
+                                else:
+                                    yield (path, result)
+                            chunk = misses
+                            if len(chunk) == 0:
+                                continue
+                        pending.add(executor.submit(cls.probeChunk, chunk, spec, cache))
+                    if len(pending) == 0:
+                        break
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        for item in future.result():
+                            yield item
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    @classmethod
+    def lookupCached(cls, path, spec, cache):
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return cache.lookup(path, queryKey('sections', spec), st)
+
+    @classmethod
+    def probeChunk(cls, paths, spec, cache=None):
+        entries = [('General', '%CompleteName%')] + specToEntries(spec)
+        stats = { }
+        if cache is not None:
+            for path in paths:
+                try:
+                    stats[path] = os.stat(path)
+                except OSError:
+                    pass
+        try:
+            data = runInformTemplate(entries, paths)
+        except MediaInfoException:
+            if len(paths) == 1:
+                return [(paths[0], MediaFileNotSupportedError('mediainfo failed: %s' % paths[0]))]
+            return [item for path in paths for item in cls.probeChunk([path], spec, cache)]
+
+        results = { }
+        for chunk in splitInformOutputByFile(data):
+            values = parseInformOutput(chunk, entries)
+            results[values[0]] = entriesToSpecResult(spec, values[1:])
+
+        items = [ ]
+        for path in paths:
+            result = results.get(path)
+            if result is None:
+                result = results.get(os.path.abspath(path))
+            if result is None:
+                result = MediaFileNotSupportedError('mediainfo returned no information: %s' % path)
+            elif path in stats:
+                cache.store(os.path.abspath(path), queryKey('sections', spec), stats[path], result)
+            items.append((path, result))
+        return items
+
+    async def aquery_sections(self, spec, timeout=None, semaphore=None):
+        """
+        asyncio version of queryMultiSections(). The number of mediainfo
+        processes running at a time is limited by semaphore, or by the
+        per-loop semaphore of setAsyncConcurrency() if not given.
+
+        timeout: seconds to wait for mediainfo, not counting the wait for
+                 the semaphore. MediaInfoTimeoutError is raised on timeout.
+        """
+        query = queryKey('sections', spec)
+        st = None
+        if self.cache is not None:
+            path = os.path.abspath(self.mediaFile)
+            st = os.stat(path)
+            result = self.cache.lookup(path, query, st)
+            if result is not None:
+                return result
+
+        entries = specToEntries(spec)
+        async with (semaphore or getAsyncSemaphore()):
+            data = await arunInformTemplate(entries, [self.mediaFile], timeout)
+        result = entriesToSpecResult(spec, parseInformOutput(data, entries))
+
+        if st is not None:
+            self.cache.store(path, query, st, result)
+        return result
+
     def querySingleClass(self, cls, tags):
         return self.querySingleSection(cls, tags)
 
     def querySingleSection(self, section, tags):
+        return self.cached(queryKey('section', {section: tags}),
+                           lambda: self.querySingleSectionImpl(section, tags))
+
+    def querySingleSectionImpl(self, section, tags):
         d = { }
         informStr = section + ';'
         for tag in tags:
@@ -64,28 +539,497 @@ class MediaInfo:
                 d[tags[i]] = ''
         return d
 
-    def queryFull(self):
-        cmd = ['mediainfo', '--Full', self.mediaFile]
-        section = None
+    def queryFull(self, fields=None):
+        """
+        Returns the dict of section -> tag -> list of values of
+        mediainfo --Full.
+
+        fields: dict of section -> list of tags to return. If given, the
+                other tags are not parsed, and mediainfo is terminated as
+                soon as all the requested sections have been read.
+        """
+        return self.cached(queryKey('full', fields), lambda: self.queryFullImpl(fields))
+
+    def queryFullImpl(self, fields=None):
         result = { }
-        with subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=False, preexec_fn = subprocessPreexec) as popen:
-            for line in popen.stdout:
-                if len(line) == 0: break
-                line = line.decode('utf-8').rstrip()
-                if len(line) == 0: continue
-                fields = line.split(':', 1)
-                if len(fields) == 1:
-                    section = fields[0]
-                    result[section] = { }
-                    continue
-                if section == None: raise MediaInfoInvalidResultError()
-                tag   = fields[0].rstrip()
-                value = fields[1].lstrip()
+        for section, tag, value in self.iterFullImpl(fields, sections=True):
+            if tag is None:
+                result[section] = { }
+            else:
                 result[section].setdefault(tag, []).append(value)
         return result
 
-    def queryMultiSections(self, spec):
+    def iterFull(self, fields=None):
+        """
+        Yields (section, tag, value) of mediainfo --Full as they are read,
+        without building the whole result. See queryFull() for fields.
+        """
+        for section, tag, value in self.iterFullImpl(fields):
+            if tag is not None:
+                yield (section, tag, value)
+
+    def iterFullImpl(self, fields=None, sections=False):
+        cmd = ['mediainfo', '--Full', self.mediaFile]
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=False, preexec_fn = subprocessPreexec) as popen:
+            try:
+                for item in parseFullOutput(popen.stdout, fields, sections):
+                    yield item
+            finally:
+                # Terminate mediainfo if the output was not read to the end.
+                if popen.poll() is None:
+                    popen.kill()
+
+    def queryMultiSections(self, spec, batch=True):
+        """
+        spec: dict of section -> list of tags.
+
+        With batch, all the sections are queried in one mediainfo
+        invocation instead of one per section.
+        """
+        if batch:
+            return self.cached(queryKey('sections', spec),
+                               lambda: entriesToSpecResult(spec, self.queryInform(specToEntries(spec))))
+
         d = { }
         for section, tags in spec.items():
             d[section] = self.querySingleSection(section, tags)
         return d
+
+
+#-------------------------------------------
+# In-process container header probe
+#-------------------------------------------
+
+class StreamInfo:
+    def __init__(self, kind):
+        self.kind = kind   # 'Video' or 'Audio'
+        self.width = None
+        self.height = None
+        self.displayWidth = None
+        self.displayHeight = None
+        self.frameRate = None
+        self.frameCount = None
+        self.duration = None   # seconds
+        self.channels = None
+        self.samplingRate = None
+
+class ContainerInfo:
+    def __init__(self, format):
+        self.format = format
+        self.duration = None   # seconds
+        self.streams = [ ]
+
+def readMP4Boxes(buf, start, end):
+    """
+    Yields (type, payload start, payload end) of the MP4 boxes in buf[start:end].
+    """
+    pos = start
+    while pos + 8 <= end:
+        size, = struct.unpack_from('>I', buf, pos)
+        boxType = bytes(buf[pos+4:pos+8])
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                break
+            size, = struct.unpack_from('>Q', buf, pos+8)
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            break
+        yield boxType, pos + header, pos + size
+        pos += size
+
+def findMP4Box(buf, start, end, boxType):
+    for t, s, e in readMP4Boxes(buf, start, end):
+        if t == boxType:
+            return s, e
+    return None
+
+def probeMP4(buf):
+    ftyp = findMP4Box(buf, 0, len(buf), b'ftyp')
+    moov = findMP4Box(buf, 0, len(buf), b'moov')
+    if ftyp is None or moov is None:
+        raise ContainerNotSupportedError('Not an MP4 file or no moov box.')
+
+    info = ContainerInfo('MPEG-4')
+    for boxType, start, end in readMP4Boxes(buf, *moov):
+        if boxType == b'mvhd':
+            if buf[start] == 1:
+                timescale, duration = struct.unpack_from('>IQ', buf, start + 20)
+            else:
+                timescale, duration = struct.unpack_from('>II', buf, start + 12)
+            if timescale > 0:
+                info.duration = float(duration) / timescale
+        elif boxType == b'trak':
+            stream = probeMP4Track(buf, start, end)
+            if stream is not None:
+                info.streams.append(stream)
+    return info
+
+def probeMP4Track(buf, start, end):
+    tkhd = findMP4Box(buf, start, end, b'tkhd')
+    mdia = findMP4Box(buf, start, end, b'mdia')
+    if mdia is None:
+        return None
+    hdlr = findMP4Box(buf, mdia[0], mdia[1], b'hdlr')
+    if hdlr is None:
+        return None
+    handler = bytes(buf[hdlr[0]+8:hdlr[0]+12])
+    if handler == b'vide':
+        stream = StreamInfo('Video')
+    elif handler == b'soun':
+        stream = StreamInfo('Audio')
+    else:
+        return None
+
+    mdhd = findMP4Box(buf, mdia[0], mdia[1], b'mdhd')
+    timescale = None
+    mediaDuration = None
+    if mdhd is not None:
+        if buf[mdhd[0]] == 1:
+            timescale, mediaDuration = struct.unpack_from('>IQ', buf, mdhd[0] + 20)
+        else:
+            timescale, mediaDuration = struct.unpack_from('>II', buf, mdhd[0] + 12)
+        if timescale > 0:
+            stream.duration = float(mediaDuration) / timescale
+
+    minf = findMP4Box(buf, mdia[0], mdia[1], b'minf')
+    stbl = minf and findMP4Box(buf, minf[0], minf[1], b'stbl')
+    if stbl is not None:
+        stsd = findMP4Box(buf, stbl[0], stbl[1], b'stsd')
+        if stsd is not None and stsd[1] - stsd[0] >= 8 + 36:
+            entry = stsd[0] + 8
+            if stream.kind == 'Video':
+                stream.width, stream.height = struct.unpack_from('>HH', buf, entry + 32)
+            else:
+                # QuickTime v1/v2 sound descriptions hold placeholders or
+                # other layouts there; leave them to mediainfo.
+                version, = struct.unpack_from('>H', buf, entry + 16)
+                if version == 0:
+                    stream.channels, = struct.unpack_from('>H', buf, entry + 24)
+                    stream.samplingRate, = struct.unpack_from('>H', buf, entry + 32)
+                    # The 16.16 field wraps for rates of 65536 Hz or more,
+                    # which usually are the media timescale.
+                    if stream.samplingRate == 0 or \
+                       (timescale is not None and timescale >= 0x10000 and
+                        timescale & 0xFFFF == stream.samplingRate):
+                        stream.samplingRate = None
+
+        stts = findMP4Box(buf, stbl[0], stbl[1], b'stts')
+        if stts is not None and stream.kind == 'Video':
+            count, = struct.unpack_from('>I', buf, stts[0] + 4)
+            frameCount = 0
+            for i in range(count):
+                n, delta = struct.unpack_from('>II', buf, stts[0] + 8 + i * 8)
+                frameCount += n
+            stream.frameCount = frameCount
+            if mediaDuration:
+                stream.frameRate = float(frameCount) * timescale / mediaDuration
+
+    if tkhd is not None and stream.kind == 'Video':
+        offset = 88 if buf[tkhd[0]] == 1 else 76
+        w, h = struct.unpack_from('>II', buf, tkhd[0] + offset)
+        if w > 0 and h > 0:
+            stream.displayWidth = w / 65536.0
+            stream.displayHeight = h / 65536.0
+    return stream
+
+# Matroska element IDs
+EBML_HEADER             = 0x1A45DFA3
+EBML_DOCTYPE            = 0x4282
+MKV_SEGMENT             = 0x18538067
+MKV_INFO                = 0x1549A966
+MKV_TIMECODESCALE       = 0x2AD7B1
+MKV_DURATION            = 0x4489
+MKV_TRACKS              = 0x1654AE6B
+MKV_TRACKENTRY          = 0xAE
+MKV_TRACKTYPE           = 0x83
+MKV_DEFAULTDURATION     = 0x23E383
+MKV_VIDEO               = 0xE0
+MKV_PIXELWIDTH          = 0xB0
+MKV_PIXELHEIGHT         = 0xBA
+MKV_DISPLAYWIDTH        = 0x54B0
+MKV_DISPLAYHEIGHT       = 0x54BA
+MKV_AUDIO               = 0xE1
+MKV_SAMPLINGFREQUENCY   = 0xB5
+MKV_CHANNELS            = 0x9F
+MKV_CLUSTER             = 0x1F43B675
+
+def readEBMLVarInt(buf, pos, keepMarker):
+    first = buf[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not (first & mask):
+        length += 1
+        mask >>= 1
+    if length > 8:
+        raise ContainerNotSupportedError('Invalid EBML variable-length integer.')
+    value = first if keepMarker else first & (mask - 1)
+    unknown = (first & (mask - 1)) == mask - 1
+    for b in buf[pos+1:pos+length]:
+        value = (value << 8) | b
+        unknown = unknown and b == 0xFF
+    return value, pos + length, unknown
+
+def readEBMLElements(buf, start, end):
+    """
+    Yields (id, data start, data end) of the EBML elements in buf[start:end].
+    Elements of unknown size extend to end.
+    """
+    pos = start
+    while pos < end:
+        elementId, pos, _ = readEBMLVarInt(buf, pos, True)
+        size, pos, unknown = readEBMLVarInt(buf, pos, False)
+        dataEnd = end if unknown else min(pos + size, end)
+        yield elementId, pos, dataEnd
+        pos = dataEnd
+
+def readEBMLUInt(buf, start, end):
+    value = 0
+    for b in buf[start:end]:
+        value = (value << 8) | b
+    return value
+
+def readEBMLFloat(buf, start, end):
+    if end - start == 4:
+        return struct.unpack_from('>f', buf, start)[0]
+    if end - start == 8:
+        return struct.unpack_from('>d', buf, start)[0]
+    return None
+
+def probeMatroska(buf):
+    if len(buf) < 4 or struct.unpack_from('>I', buf, 0)[0] != EBML_HEADER:
+        raise ContainerNotSupportedError('Not a Matroska file.')
+
+    info = None
+    for elementId, start, end in readEBMLElements(buf, 0, len(buf)):
+        if elementId == EBML_HEADER:
+            docType = b'matroska'
+            for childId, s, e in readEBMLElements(buf, start, end):
+                if childId == EBML_DOCTYPE:
+                    docType = bytes(buf[s:e]).rstrip(b'\0')
+            info = ContainerInfo('WebM' if docType == b'webm' else 'Matroska')
+        elif elementId == MKV_SEGMENT and info is not None:
+            probeMatroskaSegment(buf, start, end, info)
+            break
+    if info is None:
+        raise ContainerNotSupportedError('No EBML header.')
+    return info
+
+def probeMatroskaSegment(buf, start, end, info):
+    timecodeScale = 1000000
+    duration = None
+    foundInfo = foundTracks = False
+    for elementId, s, e in readEBMLElements(buf, start, end):
+        if elementId == MKV_INFO:
+            foundInfo = True
+            for childId, cs, ce in readEBMLElements(buf, s, e):
+                if childId == MKV_TIMECODESCALE:
+                    timecodeScale = readEBMLUInt(buf, cs, ce)
+                elif childId == MKV_DURATION:
+                    duration = readEBMLFloat(buf, cs, ce)
+        elif elementId == MKV_TRACKS:
+            foundTracks = True
+            for childId, cs, ce in readEBMLElements(buf, s, e):
+                if childId == MKV_TRACKENTRY:
+                    stream = probeMatroskaTrack(buf, cs, ce)
+                    if stream is not None:
+                        info.streams.append(stream)
+        elif elementId == MKV_CLUSTER and e == end:
+            # A cluster of unknown size; headers after it cannot be reached.
+            break
+        if foundInfo and foundTracks:
+            break
+
+    if duration is not None:
+        info.duration = duration * timecodeScale / 1e9
+    for stream in info.streams:
+        stream.duration = info.duration
+        if stream.frameRate is not None and info.duration is not None:
+            stream.frameCount = int(round(info.duration * stream.frameRate))
+
+def probeMatroskaTrack(buf, start, end):
+    trackType = None
+    defaultDuration = None
+    video = audio = None
+    for elementId, s, e in readEBMLElements(buf, start, end):
+        if elementId == MKV_TRACKTYPE:
+            trackType = readEBMLUInt(buf, s, e)
+        elif elementId == MKV_DEFAULTDURATION:
+            defaultDuration = readEBMLUInt(buf, s, e)
+        elif elementId == MKV_VIDEO:
+            video = (s, e)
+        elif elementId == MKV_AUDIO:
+            audio = (s, e)
+
+    if trackType == 1:
+        stream = StreamInfo('Video')
+        if defaultDuration:
+            stream.frameRate = 1e9 / defaultDuration
+        for elementId, s, e in readEBMLElements(buf, *(video or (0, 0))):
+            if elementId == MKV_PIXELWIDTH:
+                stream.width = readEBMLUInt(buf, s, e)
+            elif elementId == MKV_PIXELHEIGHT:
+                stream.height = readEBMLUInt(buf, s, e)
+            elif elementId == MKV_DISPLAYWIDTH:
+                stream.displayWidth = readEBMLUInt(buf, s, e)
+            elif elementId == MKV_DISPLAYHEIGHT:
+                stream.displayHeight = readEBMLUInt(buf, s, e)
+    elif trackType == 2:
+        stream = StreamInfo('Audio')
+        stream.channels = 1
+        for elementId, s, e in readEBMLElements(buf, *(audio or (0, 0))):
+            if elementId == MKV_SAMPLINGFREQUENCY:
+                samplingRate = readEBMLFloat(buf, s, e)
+                if samplingRate is not None:
+                    stream.samplingRate = int(round(samplingRate))
+            elif elementId == MKV_CHANNELS:
+                stream.channels = readEBMLUInt(buf, s, e)
+    else:
+        return None
+    return stream
+
+def probeContainer(path):
+    """
+    Parses the headers of an MP4/MOV or Matroska/WebM file in-process.
+    The file is memory-mapped, so only the pages of the headers are read.
+    Raises ContainerNotSupportedError for other formats.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 16:
+            raise ContainerNotSupportedError('File too small.')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            buf = memoryview(mm)
+            try:
+                if struct.unpack_from('>I', buf, 0)[0] == EBML_HEADER:
+                    info = probeMatroska(buf)
+                else:
+                    info = probeMP4(buf)
+            except (struct.error, IndexError):
+                raise ContainerNotSupportedError('Broken container headers.')
+            finally:
+                buf.release()
+    info.fileSize = size
+    return info
+
+def formatMilliseconds(seconds):
+    if seconds is None: return None
+    return '%d' % int(round(seconds * 1000))
+
+def formatPositive(value, format='%s'):
+    # Zero counts, rates and sizes are unknown, so that the query falls
+    # back to mediainfo.
+    if value is None or value <= 0: return None
+    return format % value
+
+def formatRatio(num, den):
+    if not num or not den: return None
+    return '%.3f' % (float(num) / den)
+
+class HeaderProbe:
+    """
+    In-process alternative to MediaInfo for a few basic fields of MP4/MOV
+    and Matroska/WebM files, without starting mediainfo. Values are
+    formatted like mediainfo --Inform does.
+
+    If the format, a requested tag or its value is not supported, the query
+    falls back to the mediainfo subprocess.
+    """
+
+    # Supported tags per section
+    TAGS = {
+        'General': ['Format', 'FileSize', 'Duration', 'VideoCount', 'AudioCount'],
+        'Video': ['Width', 'Height', 'FrameRate', 'FrameCount', 'Duration', 'DisplayAspectRatio'],
+        'Audio': ['Channels', 'SamplingRate', 'Duration'],
+    }
+
+    def __init__(self, mediaFile, fallback=None):
+        """
+        fallback: MediaInfo to query when the probe cannot answer.
+        """
+        self.mediaFile = mediaFile
+        self.fallback = fallback
+        self.info = None
+        self.error = None
+
+    def close(self):
+        if self.fallback is not None:
+            self.fallback.close()
+
+    def getFallback(self):
+        if self.fallback is None:
+            self.fallback = MediaInfo(self.mediaFile)
+        return self.fallback
+
+    def getInfo(self):
+        if self.info is None and self.error is None:
+            try:
+                self.info = probeContainer(self.mediaFile)
+            except (ContainerNotSupportedError, ValueError) as e:
+                self.error = e
+        return self.info
+
+    def getValues(self, section):
+        info = self.info
+        streams = [s for s in info.streams if s.kind == section]
+        if section == 'General':
+            return {
+                'Format': info.format,
+                'FileSize': str(info.fileSize),
+                'Duration': formatMilliseconds(info.duration),
+                'VideoCount': str(len([s for s in info.streams if s.kind == 'Video'])),
+                'AudioCount': str(len([s for s in info.streams if s.kind == 'Audio'])),
+            }
+        if len(streams) == 0:
+            return None
+        stream = streams[0]
+        if section == 'Video':
+            return {
+                'Width': formatPositive(stream.width),
+                'Height': formatPositive(stream.height),
+                'FrameRate': formatPositive(stream.frameRate, '%.3f'),
+                'FrameCount': formatPositive(stream.frameCount),
+                'Duration': formatMilliseconds(stream.duration),
+                'DisplayAspectRatio':
+                    formatRatio(stream.displayWidth, stream.displayHeight) or
+                    formatRatio(stream.width, stream.height),
+            }
+        return {
+            'Channels': formatPositive(stream.channels),
+            'SamplingRate': formatPositive(stream.samplingRate),
+            'Duration': formatMilliseconds(stream.duration),
+        }
+
+    def querySingleClass(self, cls, tags):
+        return self.querySingleSection(cls, tags)
+
+    def querySingleSection(self, section, tags):
+        d = self.queryProbe(section, tags)
+        if d is None:
+            return self.getFallback().querySingleSection(section, tags)
+        return d
+
+    def queryMultiSections(self, spec):
+        d = { }
+        for section, tags in spec.items():
+            d[section] = self.queryProbe(section, tags)
+            if d[section] is None:
+                return self.getFallback().queryMultiSections(spec)
+        return d
+
+    def queryProbe(self, section, tags):
+        # Returns None if the probe cannot answer.
+        supported = self.TAGS.get(section)
+        if supported is None or any(tag not in supported for tag in tags):
+            return None
+        if self.getInfo() is None:
+            return None
+        values = self.getValues(section)
+        if values is None:
+            # No such stream; same as mediainfo.
+            return {tag: '' for tag in tags}
+        if any(values[tag] is None for tag in tags):
+            return None
+        return {tag: values[tag] for tag in tags}
@@ -6,7 +6,8 @@ import sys
 # for backward compatibility
 from nib import (
 	encodePath,
-	progress
+	progress,
+	md5
 	)
 
 def makeRelativePath(targetPath, sourcePath):
@@ -36,19 +37,3 @@ def makeRelativePath(targetPath, sourcePath):
 		parts2 = []
 	parts1 = ['..'] * len(parts2) + parts1
 	return os.path.join(*parts1)
-
-def md5(path, file=True):
-	import hashlib
-	m = hashlib.md5()
-
-	if file:
-		f = open(path, 'rb')
-		while True:
-			data = f.read(8192)
-			if not data: break
-			m.update(data)
-		f.close()
-	else:
-		m.update(path)
-
-	return m.hexdigest()
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# nib/VideoEncoder.py is a script and imports its sibling modules directly.
+for path in (root, os.path.join(root, 'nib')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def installStub(tmp_path, monkeypatch):
+    """
+    Returns install(name, source), which installs the Python script source
+    as the command name, found first on PATH. Stubs may keep their records
+    in STUB_DIR, which is tmp_path.
+    """
+    binDir = tmp_path / 'bin'
+    binDir.mkdir()
+    monkeypatch.setenv('PATH', '%s%s%s' % (binDir, os.pathsep, os.environ['PATH']))
+    monkeypatch.setenv('STUB_DIR', str(tmp_path))
+
+    def install(name, source):
+        stub = binDir / name
+        stub.write_text('#!' + sys.executable + '\n' + source)
+        stub.chmod(0o755)
+    return install
@@ -0,0 +1,70 @@
+import concurrent.futures
+import threading
+
+import pytest
+
+from nib.async_ import Async, TaskScheduler
+
+
+def failingHandler(asy, *args):
+    raise RuntimeError('handler failed')
+
+def test_failing_success_handler_does_not_block_completion():
+    asy = Async(lambda: 5)
+    asy.on_success(failingHandler)
+    done = []
+    asy.on_done(done.append)
+    gathered = Async.gather([asy])
+    asy.start()
+    gathered.start()
+    assert asy.join(2)
+    assert asy.get() == 5
+    assert done == [asy]
+    assert gathered.get(2) == [5]
+
+def test_failing_error_handler_does_not_block_completion():
+    def fail():
+        raise ValueError('target failed')
+    asy = Async(fail)
+    asy.on_error(failingHandler)
+    done = []
+    asy.on_done(done.append)
+    asy.start()
+    assert asy.join(2)
+    assert asy.error and isinstance(asy.exception, ValueError)
+    assert done == [asy]
+
+def test_cancel_before_start():
+    asy = Async(lambda: 5)
+    asy.cancel()
+    with pytest.raises(concurrent.futures.CancelledError):
+        asy.get(2)
+
+def test_cancel_running_task_is_cooperative():
+    started = threading.Event()
+    def target(cancel_token):
+        started.set()
+        cancel_token.wait()
+        if cancel_token.cancelled and stop:
+            return 'stopped'
+        cancel_token.raise_if_cancelled()
+
+    for stop in (True, False):
+        started.clear()
+        asy = Async(target, cancellable=True)
+        asy.start()
+        assert started.wait(2)
+        asy.cancel()
+        if stop:
+            assert asy.get(2) == 'stopped'
+        else:
+            with pytest.raises(concurrent.futures.CancelledError):
+                asy.get(2)
+
+def test_scheduler_finishes_when_trace_hook_fails():
+    scheduler = TaskScheduler(max_workers=2)
+    scheduler.add('a', lambda: 1)
+    scheduler.add('b', lambda a: a + 1, deps=['a'])
+    scheduler.on_trace(lambda record: 1 / 0)
+    assert scheduler.run(5) == {'a': 1, 'b': 2}
+    assert [record['name'] for record in scheduler.trace] == ['a', 'b']
@@ -0,0 +1,39 @@
+from nib import hashing
+
+
+def writeFiles(tmp_path, contents):
+    for name, data in contents.items():
+        (tmp_path / name).write_bytes(data)
+    return [str(tmp_path / name) for name in sorted(contents)]
+
+def findDuplicates(paths, **kwargs):
+    return sorted(hashing.find_duplicates(paths, partial_size=4, max_workers=1, **kwargs))
+
+def test_find_duplicates(tmp_path):
+    paths = writeFiles(tmp_path, {
+        'a': b'0123456789', 'b': b'0123456789', 'c': b'0123x56789',
+        'd': b'012', 'e': b'012', 'f': b'xyz',
+    })
+    assert findDuplicates(paths) == [[paths[0], paths[1]], [paths[3], paths[4]]]
+
+def test_find_duplicates_unchanged_tree_is_not_read(tmp_path, monkeypatch):
+    paths = writeFiles(tmp_path, {
+        'a': b'0123456789', 'b': b'0123456789', 'c': b'0123x56789', 'd': b'xyz',
+    })
+    with hashing.DigestCache(str(tmp_path / 'cache.db')) as cache:
+        expected = [[paths[0], paths[1]]]
+        assert findDuplicates(paths, cache=cache) == expected
+
+        def noRead(*args, **kwargs):
+            raise AssertionError('file read')
+        monkeypatch.setattr(hashing, 'hash_file', noRead)
+        monkeypatch.setattr(hashing, 'hash_file_ends', noRead)
+        assert findDuplicates(paths, cache=cache) == expected
+
+def test_find_duplicates_compares_new_files_with_cached(tmp_path):
+    paths = writeFiles(tmp_path, {'a': b'0123456789', 'b': b'0123x56789'})
+    with hashing.DigestCache(str(tmp_path / 'cache.db')) as cache:
+        cache.digest(paths[0])
+        cache.digest(paths[1])
+        paths += writeFiles(tmp_path, {'c': b'0123456789'})
+        assert findDuplicates(paths, cache=cache) == [[paths[0], paths[2]]]
@@ -0,0 +1,310 @@
+import asyncio
+import json
+import os
+import struct
+
+import pytest
+
+from nib import mediainfo
+
+
+# Minimal MP4 builder
+
+def box(boxType, payload):
+    return struct.pack('>I', 8 + len(payload)) + boxType + payload
+
+def fullBox(boxType, version, payload):
+    return box(boxType, bytes([version, 0, 0, 0]) + payload)
+
+def mp4Track(handler, timescale, duration, sampleEntry, stts=None, size=(0, 0)):
+    tkhd = fullBox(b'tkhd', 0, b'\0' * 72 + struct.pack('>II', size[0] << 16, size[1] << 16))
+    mdhd = fullBox(b'mdhd', 0, struct.pack('>IIII', 0, 0, timescale, duration) + b'\0' * 4)
+    hdlr = fullBox(b'hdlr', 0, b'\0' * 4 + handler + b'\0' * 12 + b'x\0')
+    stbl = fullBox(b'stsd', 0, struct.pack('>I', 1) + sampleEntry)
+    if stts is not None:
+        stbl += fullBox(b'stts', 0, struct.pack('>I', len(stts)) +
+                        b''.join(struct.pack('>II', *e) for e in stts))
+    minf = box(b'minf', box(b'stbl', stbl))
+    return box(b'trak', tkhd + box(b'mdia', mdhd + hdlr + minf))
+
+def mp4AudioEntry(channels, rate, version=0):
+    return box(b'mp4a', b'\0' * 6 + b'\0\x01' + struct.pack('>H', version) + b'\0' * 6 +
+               struct.pack('>HHHH', channels, 16, 0, 0) + struct.pack('>I', (rate << 16) & 0xFFFFFFFF))
+
+def buildMP4(audioEntry=None, audioTimescale=48000, videoStts=[(300, 1001)]):
+    video = box(b'avc1', b'\0' * 6 + b'\0\x01' + b'\0' * 16 + struct.pack('>HH', 1440, 1080) + b'\0' * 50)
+    if audioEntry is None:
+        audioEntry = mp4AudioEntry(2, 48000)
+    mvhd = fullBox(b'mvhd', 0, struct.pack('>IIII', 0, 0, 1000, 10010) + b'\0' * 80)
+    moov = box(b'moov', mvhd +
+               mp4Track(b'vide', 30000, 300300, video, videoStts, (1920, 1080)) +
+               mp4Track(b'soun', audioTimescale, audioTimescale * 10, audioEntry))
+    return box(b'ftyp', b'isom\0\0\0\x01isom') + box(b'mdat', b'\0' * 1000) + moov
+
+
+# Minimal Matroska builder
+
+def element(elementId, data):
+    # Sizes are always written as 4-byte vints.
+    return elementId.to_bytes((elementId.bit_length() + 7) // 8, 'big') + \
+        b'\x10' + len(data).to_bytes(3, 'big') + data
+
+def uintElement(elementId, value):
+    return element(elementId, value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big'))
+
+def buildWebM():
+    unknownSize = b'\x01\xff\xff\xff\xff\xff\xff\xff'
+    header = element(mediainfo.EBML_HEADER, element(mediainfo.EBML_DOCTYPE, b'webm'))
+    info = element(mediainfo.MKV_INFO,
+                   uintElement(mediainfo.MKV_TIMECODESCALE, 1000000) +
+                   element(mediainfo.MKV_DURATION, struct.pack('>d', 5000.0)))
+    video = element(mediainfo.MKV_TRACKENTRY,
+                    uintElement(mediainfo.MKV_TRACKTYPE, 1) +
+                    uintElement(mediainfo.MKV_DEFAULTDURATION, 41708333) +
+                    element(mediainfo.MKV_VIDEO,
+                            uintElement(mediainfo.MKV_PIXELWIDTH, 720) +
+                            uintElement(mediainfo.MKV_PIXELHEIGHT, 480) +
+                            uintElement(mediainfo.MKV_DISPLAYWIDTH, 16) +
+                            uintElement(mediainfo.MKV_DISPLAYHEIGHT, 9)))
+    audio = element(mediainfo.MKV_TRACKENTRY,
+                    uintElement(mediainfo.MKV_TRACKTYPE, 2) +
+                    element(mediainfo.MKV_AUDIO,
+                            element(mediainfo.MKV_SAMPLINGFREQUENCY, struct.pack('>f', 44100.0)) +
+                            uintElement(mediainfo.MKV_CHANNELS, 6)))
+    cluster = struct.pack('>I', mediainfo.MKV_CLUSTER) + unknownSize + b'\0' * 100
+    segment = struct.pack('>I', mediainfo.MKV_SEGMENT) + unknownSize + info + \
+        element(mediainfo.MKV_TRACKS, video + audio) + cluster
+    return header + segment
+
+
+class FallbackMediaInfo:
+    # Stands in for MediaInfo and records the queries it gets.
+    def __init__(self):
+        self.queries = []
+
+    def querySingleSection(self, section, tags):
+        self.queries.append((section, tags))
+        return {tag: 'fallback' for tag in tags}
+
+    def close(self):
+        pass
+
+
+def probeAll(path, fallback=None):
+    probe = mediainfo.HeaderProbe(str(path), fallback=fallback)
+    return {section: probe.querySingleSection(section, tags)
+            for section, tags in mediainfo.HeaderProbe.TAGS.items()}
+
+
+def test_header_probe_mp4(tmp_path):
+    path = tmp_path / 'a.mp4'
+    path.write_bytes(buildMP4())
+    fallback = FallbackMediaInfo()
+    assert probeAll(path, fallback) == {
+        'General': {'Format': 'MPEG-4', 'FileSize': str(path.stat().st_size),
+                    'Duration': '10010', 'VideoCount': '1', 'AudioCount': '1'},
+        'Video': {'Width': '1440', 'Height': '1080', 'FrameRate': '29.970',
+                  'FrameCount': '300', 'Duration': '10010', 'DisplayAspectRatio': '1.778'},
+        'Audio': {'Channels': '2', 'SamplingRate': '48000', 'Duration': '10000'},
+    }
+    assert fallback.queries == []
+
+def test_header_probe_matroska(tmp_path):
+    path = tmp_path / 'a.webm'
+    path.write_bytes(buildWebM())
+    fallback = FallbackMediaInfo()
+    assert probeAll(path, fallback) == {
+        'General': {'Format': 'WebM', 'FileSize': str(path.stat().st_size),
+                    'Duration': '5000', 'VideoCount': '1', 'AudioCount': '1'},
+        'Video': {'Width': '720', 'Height': '480', 'FrameRate': '23.976',
+                  'FrameCount': '120', 'Duration': '5000', 'DisplayAspectRatio': '1.778'},
+        'Audio': {'Channels': '6', 'SamplingRate': '44100', 'Duration': '5000'},
+    }
+    assert fallback.queries == []
+
+@pytest.mark.parametrize('audioEntry, audioTimescale', [
+    (mp4AudioEntry(2, 48000, version=1), 48000),
+    (mp4AudioEntry(2, 48000, version=2), 48000),
+    (mp4AudioEntry(2, 96000), 96000),
+], ids=['v1', 'v2', 'wrapped-rate'])
+def test_header_probe_mp4_audio_fallback(tmp_path, audioEntry, audioTimescale):
+    path = tmp_path / 'a.mov'
+    path.write_bytes(buildMP4(audioEntry, audioTimescale))
+    fallback = FallbackMediaInfo()
+    probe = mediainfo.HeaderProbe(str(path), fallback=fallback)
+    tags = ['Channels', 'SamplingRate']
+    assert probe.querySingleSection('Audio', tags) == {'Channels': 'fallback', 'SamplingRate': 'fallback'}
+    assert fallback.queries == [('Audio', tags)]
+
+def test_header_probe_mp4_no_frames_fallback(tmp_path):
+    # An empty stts gives 0 frames at 0 fps, which must not be reported.
+    path = tmp_path / 'a.mp4'
+    path.write_bytes(buildMP4(videoStts=[]))
+    fallback = FallbackMediaInfo()
+    probe = mediainfo.HeaderProbe(str(path), fallback=fallback)
+    tags = ['Width', 'FrameRate', 'FrameCount']
+    assert probe.querySingleSection('Video', tags) == {tag: 'fallback' for tag in tags}
+    assert fallback.queries == [('Video', tags)]
+    assert probe.querySingleSection('Video', ['Width', 'Height']) == {'Width': '1440', 'Height': '1080'}
+
+def test_header_probe_unsupported_container(tmp_path):
+    path = tmp_path / 'a.avi'
+    path.write_bytes(b'RIFF' + b'\0' * 100)
+    fallback = FallbackMediaInfo()
+    probe = mediainfo.HeaderProbe(str(path), fallback=fallback)
+    assert probe.querySingleSection('General', ['Format']) == {'Format': 'fallback'}
+
+
+# Stand-in for the mediainfo command, answering --Inform templates given
+# inline or as file://. A media file holds the JSON dict of section -> list
+# of streams (dicts of tag -> value); CompleteName is set to the path. A
+# file which is not JSON makes the whole run fail. Each run is recorded
+# under STUB_DIR: a file named after the pid exists while it runs, and the
+# number of runs at start time is appended to STUB_DIR/counts.
+STUB_MEDIAINFO = r"""
+import json, os, re, sys, time
+stubDir = os.environ['STUB_DIR']
+running = os.path.join(stubDir, 'running')
+open(os.path.join(running, str(os.getpid())), 'w').close()
+with open(os.path.join(stubDir, 'counts'), 'a') as f:
+    f.write('%d\n' % len(os.listdir(running)))
+time.sleep(float(os.environ.get('STUB_SLEEP', '0')))
+template = sys.argv[1][len('--Inform='):]
+if template.startswith('file://'):
+    template = open(template[len('file://'):]).read()
+bodies = dict(line.split(';', 1) for line in template.splitlines())
+for path in sys.argv[2:]:
+    try:
+        streams = json.load(open(path))
+    except ValueError:
+        sys.exit(1)
+    if 'General' in streams:
+        streams['General'][0]['CompleteName'] = path
+    for section in ('General', 'Video', 'Audio', 'Text'):
+        for stream in streams.get(section, []) if section in bodies else []:
+            body = re.sub('%([^%]+)%', lambda m: stream.get(m.group(1), ''), bodies[section])
+            sys.stdout.write(body.replace('\\n', '\n'))
+os.remove(os.path.join(running, str(os.getpid())))
+"""
+
+MEDIA = {
+    'General': [{'Format': 'Matroska', 'Duration': '5000'}],
+    'Video': [{'Width': '640', 'Height': '480'}],
+    'Audio': [{'Channels': '2'}],
+}
+
+def writeMedia(path, streams):
+    path.write_text(json.dumps(streams))
+    return str(path)
+
+@pytest.fixture
+def stubMediaInfo(tmp_path, installStub):
+    installStub('mediainfo', STUB_MEDIAINFO)
+    (tmp_path / 'running').mkdir()
+    return tmp_path, writeMedia(tmp_path / 'a.mkv', MEDIA)
+
+def stubCounts(stubDir):
+    with open(stubDir / 'counts') as f:
+        return [int(line) for line in f]
+
+def test_aquery_sections(stubMediaInfo):
+    stubDir, media = stubMediaInfo
+    spec = {'General': ['Format', 'Duration'], 'Video': ['Width', 'Height'], 'Audio': ['Channels']}
+    result = asyncio.run(mediainfo.MediaInfo(media).aquery_sections(spec))
+    assert result == {
+        'General': {'Format': 'Matroska', 'Duration': '5000'},
+        'Video': {'Width': '640', 'Height': '480'},
+        'Audio': {'Channels': '2'},
+    }
+
+def test_aquery_sections_timeout(stubMediaInfo, monkeypatch):
+    stubDir, media = stubMediaInfo
+    monkeypatch.setenv('STUB_SLEEP', '30')
+    with pytest.raises(mediainfo.MediaInfoTimeoutError):
+        asyncio.run(mediainfo.MediaInfo(media).aquery_sections({'General': ['Format']}, timeout=0.5))
+    pids = [int(name) for name in os.listdir(stubDir / 'running')]
+    assert len(pids) == 1
+    # Killed and reaped
+    with pytest.raises(ProcessLookupError):
+        os.kill(pids[0], 0)
+
+def test_aquery_sections_semaphore(stubMediaInfo, monkeypatch):
+    stubDir, media = stubMediaInfo
+    monkeypatch.setenv('STUB_SLEEP', '0.3')
+
+    async def queryAll():
+        semaphore = asyncio.Semaphore(2)
+        return await asyncio.gather(*[
+            mediainfo.MediaInfo(media).aquery_sections({'General': ['Format']}, semaphore=semaphore)
+            for i in range(6)])
+
+    results = asyncio.run(queryAll())
+    assert results == [{'General': {'Format': 'Matroska'}}] * 6
+    counts = stubCounts(stubDir)
+    assert len(counts) == 6
+    assert max(counts) == 2
+
+def test_set_async_concurrency(stubMediaInfo, monkeypatch):
+    stubDir, media = stubMediaInfo
+    monkeypatch.setenv('STUB_SLEEP', '0.3')
+    monkeypatch.setattr(mediainfo, 'asyncConcurrency', mediainfo.asyncConcurrency)
+    mediainfo.setAsyncConcurrency(3)
+
+    async def queryAll():
+        return await asyncio.gather(*[
+            mediainfo.MediaInfo(media).aquery_sections({'General': ['Format']})
+            for i in range(6)])
+
+    asyncio.run(queryAll())
+    assert max(stubCounts(stubDir)) == 3
+
+
+def test_query_multi_sections(stubMediaInfo):
+    stubDir, media = stubMediaInfo
+    writeMedia(stubDir / 'a.mkv', {
+        'General': [{'Format': 'Matroska', 'Duration': '5000'}],
+        'Video': [{'Width': '640', 'Height': '480'}],
+        'Audio': [{'Channels': '2', 'Language': 'en'}, {'Channels': '6', 'Language': 'ja'}],
+    })
+    spec = {'General': ['Format', 'Duration'], 'Video': ['Width', 'Height'],
+            'Audio': ['Channels', 'Language'], 'Text': ['Language']}
+    expected = {
+        'General': {'Format': 'Matroska', 'Duration': '5000'},
+        'Video': {'Width': '640', 'Height': '480'},
+        # Values of the first stream
+        'Audio': {'Channels': '2', 'Language': 'en'},
+        # No such section
+        'Text': {'Language': ''},
+    }
+    mi = mediainfo.MediaInfo(media)
+    assert mi.queryMultiSections(spec, batch=True) == expected
+    assert len(stubCounts(stubDir)) == 1
+    assert mi.queryMultiSections(spec, batch=False) == expected
+
+def test_probe_many(stubMediaInfo):
+    stubDir, media = stubMediaInfo
+    paths = [writeMedia(stubDir / ('%d.mkv' % i), {
+        'General': [{'Format': 'Matroska', 'Duration': str(i * 1000)}],
+        'Video': [{'Width': str(i * 100)}],
+    }) for i in range(1, 4)]
+    spec = {'General': ['Duration'], 'Video': ['Width'], 'Audio': ['Channels']}
+    results = dict(mediainfo.MediaInfo.probe_many(paths, spec, chunk_size=3, max_workers=1))
+    assert results == {
+        path: {'General': {'Duration': str(i * 1000)}, 'Video': {'Width': str(i * 100)},
+               'Audio': {'Channels': ''}}
+        for i, path in enumerate(paths, 1)
+    }
+    assert len(stubCounts(stubDir)) == 1
+
+def test_probe_many_isolates_failing_files(stubMediaInfo):
+    stubDir, media = stubMediaInfo
+    crashing = stubDir / 'crash.mkv'
+    crashing.write_text('not json')
+    empty = writeMedia(stubDir / 'empty.mkv', {})
+    paths = [media, str(crashing), empty]
+    results = dict(mediainfo.MediaInfo.probe_many(paths, {'General': ['Format']}, chunk_size=3, max_workers=1))
+    assert results[media] == {'General': {'Format': 'Matroska'}}
+    assert isinstance(results[str(crashing)], mediainfo.MediaFileNotSupportedError)
+    assert isinstance(results[empty], mediainfo.MediaFileNotSupportedError)
+    # The failed chunk, then each file alone.
+    assert len(stubCounts(stubDir)) == 4
@@ -0,0 +1,211 @@
+import json
+import os
+
+import pytest
+
+import VideoEncoder
+
+
+class FakeSegment:
+    # Stands in for the VideoEncodeExecutor of a segment, writing its
+    # output when started.
+    def __init__(self, outfile, data, returnCode=0):
+        self.outfile = outfile
+        self.data = data
+        self.returnCode = returnCode
+        self.started = False
+        self.killed = False
+
+    def start(self):
+        self.started = True
+        with open(self.outfile, 'wb') as f:
+            f.write(self.data)
+
+    def setUpdateEvent(self, event):
+        pass
+
+    def getReturnCode(self):
+        return self.returnCode if self.started else None
+
+    def getProgress(self):
+        return (10, None)
+
+    def kill(self):
+        self.killed = True
+
+
+def segmentedExecutor(tmp_path, returnCodes, maxJobs=2):
+    mi = {'Video': {'Width': '640', 'Height': '480', 'FrameCount': '30'}}
+    outfile = str(tmp_path / 'video.264')
+    executor = VideoEncoder.SegmentedVideoEncodeExecutor(
+        'in.mkv', outfile, mi, [([], 10)] * len(returnCodes), maxJobs)
+    segments = [FakeSegment('%s.%d' % (outfile, i), b'%d' % i, ret)
+                for i, ret in enumerate(returnCodes)]
+    executor.pending = [(segment, 10) for segment in reversed(segments)]
+    return executor, segments
+
+def test_segmented_finish_concatenates(tmp_path):
+    executor, segments = segmentedExecutor(tmp_path, [0, 0, 0])
+    executor.start()
+    while executor.getReturnCode() == None:
+        pass
+    assert executor.getProgress() == (30, 30)
+    # Nothing is copied while polling.
+    assert not (tmp_path / 'video.264').exists()
+    executor.finish()
+    assert (tmp_path / 'video.264').read_bytes() == b'012'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['video.264']
+
+def test_segmented_failure_kills_running_segments(tmp_path):
+    executor, segments = segmentedExecutor(tmp_path, [1, None, 0], maxJobs=2)
+    executor.start()
+    assert executor.getReturnCode() == 1
+    # The running segment is killed with its decoder; the pending one is
+    # never started.
+    assert segments[1].killed
+    assert not segments[2].started
+
+def batchEncoder(tmp_path, manifest):
+    path = tmp_path / 'manifest'
+    path.write_text(''.join(line + '\n' for line in manifest))
+    parser = VideoEncoder.VideoEncoder().getArgumentParser()
+    return VideoEncoder.BatchEncoder(parser.parse_args(['--batch', str(path), '-o', 'out']))
+
+def test_batch_default_outfiles_get_suffix(tmp_path):
+    encoder = batchEncoder(tmp_path, ['a/x.mkv', 'b/x.mp4', 'c/x.avi', 'c/y.avi\tout/x-1.mp4'])
+    assert encoder.getInputs() == [
+        ('a/x.mkv', 'out/x.mp4'),
+        ('b/x.mp4', 'out/x-2.mp4'),
+        ('c/x.avi', 'out/x-3.mp4'),
+        ('c/y.avi', 'out/x-1.mp4'),
+    ]
+
+def test_batch_keeps_outfiles_of_state(tmp_path):
+    encoder = batchEncoder(tmp_path, ['0/x.mkv', 'a/x.mkv'])
+    encoder.jobs = {'a/x.mkv': {'infile': 'a/x.mkv', 'outfile': 'out/x.mp4', 'status': 'done', 'attempts': 1}}
+    assert encoder.getInputs() == [('0/x.mkv', 'out/x-1.mp4'), ('a/x.mkv', 'out/x.mp4')]
+
+def test_batch_duplicate_explicit_outfiles(tmp_path):
+    encoder = batchEncoder(tmp_path, ['a/x.mkv\tout/same.mp4', 'b/y.mkv\tout/./same.mp4'])
+    with pytest.raises(VideoEncoder.VideoEncoderError):
+        encoder.getInputs()
+
+
+# Stand-ins for the external commands run by VideoEncoder.run(). MP4Box
+# appends its working directory and arguments to STUB_DIR/MP4Box.
+STUB_COMMANDS = {
+    'ffmpeg': r"""
+import sys
+if sys.argv[-1] == '-':
+    sys.stdout.buffer.write(b'\0' * 100000)
+""",
+    'x264': r"""
+import sys
+sys.stdin.buffer.read()
+with open(sys.argv[sys.argv.index('--output') + 1], 'wb') as f:
+    f.write(b'h264')
+sys.stderr.write('10/10 frames, 100.00 fps\r')
+""",
+    'faac': r"""
+import sys
+sys.stdin.buffer.read()
+with open(sys.argv[sys.argv.index('-o') + 1], 'wb') as f:
+    f.write(b'aac')
+""",
+    'MP4Box': r"""
+import json, os, sys
+args = sys.argv[1:]
+with open(os.path.join(os.environ['STUB_DIR'], 'MP4Box'), 'a') as f:
+    f.write(json.dumps([os.getcwd(), args]) + '\n')
+inputs = [args[i + 1] for i, arg in enumerate(args) if arg == '-add']
+with open(args[args.index('-new') + 1], 'wb') as f:
+    for path in inputs:
+        with open(path, 'rb') as fin:
+            f.write(fin.read())
+""",
+}
+
+STUB_MEDIA_INFO = {
+    'General': {'VideoCount': '1', 'AudioCount': '1', 'FileSize': '1000', 'Duration': '400'},
+    'Video': {'Width': '640', 'Height': '480', 'FrameRate': '25.000', 'FrameCount': '10',
+              'DisplayAspectRatio': '1.333'},
+    'Audio': {'Channels': '2', 'SamplingRate': '48000'},
+}
+
+@pytest.fixture
+def stubCommands(tmp_path, installStub, monkeypatch):
+    for name, source in STUB_COMMANDS.items():
+        installStub(name, source)
+    monkeypatch.setattr(VideoEncoder.VideoEncoder, 'getMediaInfo', lambda self, file: STUB_MEDIA_INFO)
+    return tmp_path
+
+def test_run_muxes_and_hints_in_one_mp4box_call(stubCommands):
+    infile = stubCommands / 'in.mkv'
+    infile.write_bytes(b'\0' * 1000)
+    outdir = stubCommands / 'out'
+    outdir.mkdir()
+    outfile = outdir / 'out.mp4'
+
+    encoder = VideoEncoder.VideoEncoder()
+    args = encoder.getArgumentParser().parse_args(['-i', str(infile), '-o', str(outfile), '--force'])
+    assert encoder.run(args) == 0
+
+    with open(stubCommands / 'MP4Box') as f:
+        calls = [json.loads(line) for line in f]
+    assert len(calls) == 1
+    cwd, mp4BoxArgs = calls[0]
+    tempOut = str(outdir / '.out.mp4.VideoEncoder.tmp.mp4')
+    assert mp4BoxArgs == [
+        '-add', os.path.join(cwd, 'video.264'),
+        '-fps', '25.000',
+        '-par', '1=1920:1920',
+        '-add', os.path.join(cwd, 'audio.aac'),
+        '-hint',
+        '-tmp', str(outdir),
+        '-new', tempOut,
+    ]
+    # The temporary directory holding the elementary streams is removed.
+    assert not os.path.exists(cwd)
+    assert outfile.read_bytes() == b'h264aac'
+    assert sorted(os.listdir(outdir)) == ['out.mp4']
+
+@pytest.mark.parametrize('telemetry', ['unix:%s', '%s/telemetry.jsonl', 'tcp:localhost'],
+                         ids=['no-socket', 'no-directory', 'no-port'])
+def test_run_without_telemetry_destination(stubCommands, capsys, telemetry):
+    infile = stubCommands / 'in.mkv'
+    infile.write_bytes(b'\0' * 1000)
+    outfile = stubCommands / 'out.mp4'
+    dest = telemetry % (stubCommands / 'missing') if '%s' in telemetry else telemetry
+
+    encoder = VideoEncoder.VideoEncoder()
+    args = encoder.getArgumentParser().parse_args(
+        ['-i', str(infile), '-o', str(outfile), '--force', '--telemetry', dest])
+    assert encoder.run(args) == 0
+    assert 'Telemetry disabled' in capsys.readouterr().err
+    assert outfile.exists()
+
+def test_run_segments_of_unknown_frame_rate(stubCommands, monkeypatch, capsys):
+    mi = dict(STUB_MEDIA_INFO, Video=dict(STUB_MEDIA_INFO['Video'], FrameRate=''))
+    monkeypatch.setattr(VideoEncoder.VideoEncoder, 'getMediaInfo', lambda self, file: mi)
+    infile = stubCommands / 'in.mkv'
+    infile.write_bytes(b'\0' * 1000)
+    outfile = stubCommands / 'out.mp4'
+
+    encoder = VideoEncoder.VideoEncoder()
+    args = encoder.getArgumentParser().parse_args(
+        ['-i', str(infile), '-o', str(outfile), '--force', '--segments', '2'])
+    assert encoder.run(args) == 1
+    assert 'unknown frame rate' in capsys.readouterr().out
+    assert not outfile.exists()
+
+def test_run_handles_encoder_exit_at_once(stubCommands, monkeypatch):
+    # The loop is woken up by the exit of the encoders, not by the timeout.
+    monkeypatch.setattr(VideoEncoder.VideoEncoder, 'progressInterval', 10)
+    infile = stubCommands / 'in.mkv'
+    infile.write_bytes(b'\0' * 1000)
+
+    encoder = VideoEncoder.VideoEncoder()
+    args = encoder.getArgumentParser().parse_args(
+        ['-i', str(infile), '-o', str(stubCommands / 'out.mp4'), '--force'])
+    assert encoder.run(args) == 0
+    assert encoder.stages['encode'] < 5